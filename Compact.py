@@ -0,0 +1,78 @@
+### Compact hash tables shared by assoc.py and colx.py
+
+from array import array
+
+class CompactKeys(object):
+    """Compact set of strings, each identified by an entry number (its insertion order).
+Keys are stored UTF-8 encoded in a single contiguous buffer, with their end offsets and
+hashes in typed arrays; an open-addressing index table maps hash slots to entry numbers.
+Subclasses keep the data associated with each key in parallel arrays, indexed by entry
+number, appending to them whenever insert() reports a new key."""
+    _keys = None                # bytearray holding all keys back to back
+    _ends = None                # end offset of each key in _keys
+    _hashes = None              # hash of each key
+    _index = None               # slot -> entry number, or -1 if empty
+    _slotmask = 0
+
+    def __init__(self, size=1024):
+        self._keys = bytearray()
+        self._ends = array('Q')
+        self._hashes = array('q')
+        self._resize(size)
+
+    def __len__(self):
+        return len(self._ends)
+
+    def _resize(self, size):
+        self._index = array('i', [-1]) * size
+        self._slotmask = size - 1
+        for i in range(len(self._hashes)):
+            slot = self._hashes[i] & self._slotmask
+            while self._index[slot] != -1:
+                slot = (slot + 1) & self._slotmask
+            self._index[slot] = i
+
+    def _key(self, i):
+        start = self._ends[i-1] if i > 0 else 0
+        return bytes(self._keys[start:self._ends[i]])
+
+    def _find(self, kb, h):
+        """Return the slot containing key `kb' (with hash `h'), or the empty slot where it would go."""
+        index = self._index
+        slot = h & self._slotmask
+        while True:
+            i = index[slot]
+            if i == -1 or (self._hashes[i] == h and self._key(i) == kb):
+                return slot
+            slot = (slot + 1) & self._slotmask
+
+    def lookup(self, key):
+        """Return the entry number of `key', or -1 if it is not present."""
+        kb = key.encode("utf-8")
+        return self._index[self._find(kb, hash(kb))]
+
+    def insert(self, key):
+        """Return a tuple (entry number, new) for `key', adding it if necessary. `new' is
+True if the key was added, in which case the caller must append its data."""
+        kb = key.encode("utf-8")
+        h = hash(kb)
+        slot = self._find(kb, h)
+        i = self._index[slot]
+        if i != -1:
+            return (i, False)
+        self._keys.extend(kb)
+        self._ends.append(len(self._keys))
+        self._hashes.append(h)
+        i = len(self._ends) - 1
+        self._index[slot] = i
+        if 2 * len(self._ends) > len(self._index):
+            self._resize(2 * len(self._index))
+        return (i, True)
+
+    def keys(self):
+        """Iterate over the keys in insertion order."""
+        keys = self._keys
+        start = 0
+        for end in self._ends:
+            yield keys[start:end].decode("utf-8")
+            start = end
@@ -2,9 +2,22 @@
 
 """assoc.py - build association table from tab-delimited file, and decode lines from stdin."""
 
+import os
+import re
 import sys
 import csv
 import json
+import mmap
+import struct
+import signal
+import socket
+import asyncio
+import hashlib
+import tempfile
+from bisect import bisect_left, bisect_right
+from array import array
+from itertools import repeat
+from Compact import CompactKeys
 
 def parseFilename(s):
     p = s.rfind(":")
@@ -13,6 +26,18 @@ def parseFilename(s):
     else:
         return (s, False)
 
+def parseHopSpec(s):
+    """Parse a hop specification of the form filename[:I[:O]][:keep]. Returns a tuple
+(filename, incol, outcol, keep) with 0-based columns; incol defaults to the first column,
+outcol to the one after incol."""
+    parts = s.split(":")
+    keep = False
+    if len(parts) > 1 and parts[-1] in ["keep", "fail"]:
+        keep = (parts.pop() == "keep")
+    incol = int(parts[1]) - 1 if len(parts) > 1 else 0
+    outcol = int(parts[2]) - 1 if len(parts) > 2 else incol + 1
+    return (parts[0], incol, outcol, keep)
+
 def decodeDelimiter(d):
     if d == 'tab':
         return '\t'
@@ -23,6 +48,462 @@ def decodeDelimiter(d):
     else:
         return d
 
+def readBlocks(stream, size=1048576):
+    """Read `stream' in blocks of approximately `size' bytes, yielding lists of lines."""
+    while True:
+        lines = stream.readlines(size)
+        if not lines:
+            return
+        yield lines
+
+JSON_OPEN = re.compile(r'[ \t\n\r]*\{')
+JSON_CLOSE = re.compile(r'[ \t\n\r]*\}')
+JSON_KEY = re.compile(r'[ \t\n\r]*"((?:[^"\\]|\\.)*)"[ \t\n\r]*:[ \t\n\r]*', re.S)
+JSON_SEP = re.compile(r'[ \t\n\r]*([,}])')
+
+def parseJSONChunk(buf, pos):
+    """Parse all the complete key/value pairs in buf[pos:] at once, up to one of the last
+commas. Returns a tuple (dict, position after the comma), or (None, pos) if this fails.
+If the comma is not at the top level (ie, it is inside a string or a nested value) the
+text cannot parse, since the braces we add would not balance, so the result is never
+wrong; in that case we try a couple of earlier commas before giving up."""
+    cut = len(buf)
+    for attempt in range(3):
+        cut = buf.rfind(",", pos, cut)
+        if cut <= pos:
+            break
+        try:
+            return (json.loads("{" + buf[pos:cut] + "}"), cut + 1)
+        except ValueError:
+            pass
+    return (None, pos)
+
+def iterJSONPairs(f, chunksize=1048576):
+    """Incrementally parse a flat JSON object from stream `f', yielding its (key, value)
+pairs as they are parsed. The text is read in chunks of `chunksize' characters, so only
+a small part of it is in memory at any time."""
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    offset = 0                  # position of buf in the whole text
+    eof = False
+    started = False
+    fast = True
+    while True:
+        if not started:
+            m = JSON_OPEN.match(buf, pos)
+            if m:
+                pos = m.end()
+                started = True
+                continue
+        elif JSON_CLOSE.match(buf, pos):
+            return
+        else:
+            if fast:
+                (pairs, newpos) = parseJSONChunk(buf, pos)
+                if pairs is None:
+                    fast = False    # parse one pair at a time until more text is read
+                else:
+                    for pair in pairs.items():
+                        yield pair
+                    pos = newpos
+                    continue
+            m = JSON_KEY.match(buf, pos)
+            if m and m.end() < len(buf):
+                try:
+                    (value, end) = decoder.raw_decode(buf, m.end())
+                    # Requiring `,' or `}' after the value ensures that it was not
+                    # truncated at the end of the buffer (eg, a number).
+                    sep = JSON_SEP.match(buf, end)
+                except ValueError:
+                    sep = None
+                if sep:
+                    key = m.group(1)
+                    if "\\" in key:
+                        key = json.decoder.scanstring(buf, m.start(1))[0]
+                    yield (key, value)
+                    pos = sep.end()
+                    if sep.group(1) == "}":
+                        return
+                    continue
+        # The next element is incomplete: read more, or give up.
+        if eof:
+            raise ValueError("Malformed JSON mapping at character {}".format(offset + pos))
+        chunk = f.read(chunksize)
+        if not chunk:
+            eof = True
+        offset += pos
+        buf = buf[pos:] + chunk
+        pos = 0
+        fast = True
+
+def keyHash(kb):
+    """Stable 64-bit hash of byte string `kb'."""
+    return struct.unpack("<Q", hashlib.md5(kb).digest()[:8])[0]
+
+class CompactTable(CompactKeys):
+    """Compact in-memory mapping from strings to strings: a CompactKeys with the values stored
+UTF-8 encoded in a second contiguous buffer, and their offsets in parallel typed arrays.
+Values are only decoded when they are looked up. Supports the subset of the dict interface
+used by Assoc."""
+    _vals = None                # bytearray of all values
+    _vstarts = None             # start offset of each value in _vals
+    _vends = None               # end offset of each value in _vals
+
+    def __init__(self, size=1024):
+        CompactKeys.__init__(self, size)
+        self._vals = bytearray()
+        self._vstarts = array('Q')
+        self._vends = array('Q')
+
+    def _value(self, i):
+        return self._vals[self._vstarts[i]:self._vends[i]].decode("utf-8")
+
+    def __setitem__(self, key, value):
+        (i, new) = self.insert(key)
+        vstart = len(self._vals)
+        self._vals.extend(str(value).encode("utf-8"))
+        if new:
+            self._vstarts.append(vstart)
+            self._vends.append(len(self._vals))
+        else:                   # replace value; the old bytes are simply abandoned
+            self._vstarts[i] = vstart
+            self._vends[i] = len(self._vals)
+
+    def get(self, key, default=None):
+        i = self.lookup(key)
+        return default if i == -1 else self._value(i)
+
+    def __contains__(self, key):
+        return self.lookup(key) != -1
+
+    def __getitem__(self, key):
+        v = self.get(key)
+        if v is None:
+            raise KeyError(key)
+        return v
+
+    def items(self):
+        return zip(self.keys(), map(self._value, range(len(self))))
+
+class TableIndex(object):
+    """Persistent, memory-mapped hash index of a mapping table. The index file contains
+a header (magic, size and mtime of the source file, number of slots, number of entries,
+and a string describing the options used to build it), followed by an open-addressing
+table of (hash, record offset) slots and by the records themselves, each consisting of
+key length, value length, key and value. Lookups only touch the pages they need, so
+opening an index is instantaneous regardless of the size of the table."""
+    magic = b"ASSOCIX1"
+    header = struct.Struct("<8sQdQQI")
+    slot = struct.Struct("<QQ")
+    record = struct.Struct("<II")
+    _mm = None
+    _f = None
+    _slotbase = 0
+    _mask = 0
+    _n = 0
+
+    def __init__(self, path, mm, f):
+        self._f = f
+        self._mm = mm
+        (magic, size, mtime, nslots, n, olen) = self.header.unpack_from(mm, 0)
+        self._slotbase = self.header.size + olen
+        self._mask = nslots - 1
+        self._n = n
+
+    @classmethod
+    def open(cls, path, source, options):
+        """Open the index in `path'. Returns None if it does not exist, or if it is stale
+(ie, `source' has changed since it was built, or it was built with different options)."""
+        if not os.path.isfile(path) or os.path.getsize(path) < cls.header.size:
+            return None
+        st = os.stat(source)
+        f = open(path, "rb")
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, size, mtime, nslots, n, olen) = cls.header.unpack_from(mm, 0)
+        if magic != cls.magic or size != st.st_size or mtime != st.st_mtime or \
+           mm[cls.header.size:cls.header.size+olen] != options.encode("utf-8"):
+            mm.close()
+            f.close()
+            return None
+        return cls(path, mm, f)
+
+    @classmethod
+    def build(cls, path, source, options, data):
+        """Write an index for dictionary `data', read from file `source', to `path'."""
+        st = os.stat(source)
+        nslots = 8
+        while nslots < 2 * len(data):
+            nslots *= 2
+        mask = nslots - 1
+        opts = options.encode("utf-8")
+        slots = [ (0, 0) ] * nslots
+        offset = cls.header.size + len(opts) + nslots * cls.slot.size
+        (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                out.seek(offset)
+                for (k, v) in data.items():
+                    kb = k.encode("utf-8")
+                    vb = str(v).encode("utf-8")
+                    h = keyHash(kb)
+                    i = h & mask
+                    while slots[i][1] != 0:
+                        i = (i + 1) & mask
+                    slots[i] = (h, offset)
+                    out.write(cls.record.pack(len(kb), len(vb)))
+                    out.write(kb)
+                    out.write(vb)
+                    offset += cls.record.size + len(kb) + len(vb)
+                out.seek(0)
+                out.write(cls.header.pack(cls.magic, st.st_size, st.st_mtime, nslots, len(data), len(opts)))
+                out.write(opts)
+                out.write(b"".join([ cls.slot.pack(h, o) for (h, o) in slots ]))
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            os.remove(tmp)
+            raise
+
+    def __len__(self):
+        return self._n
+
+    def get(self, key, default=None):
+        kb = key.encode("utf-8")
+        h = keyHash(kb)
+        mm = self._mm
+        i = h & self._mask
+        while True:
+            (sh, off) = self.slot.unpack_from(mm, self._slotbase + i * self.slot.size)
+            if off == 0:
+                return default
+            if sh == h:
+                (kl, vl) = self.record.unpack_from(mm, off)
+                start = off + self.record.size
+                if mm[start:start+kl] == kb:
+                    return mm[start+kl:start+kl+vl].decode("utf-8")
+            i = (i + 1) & self._mask
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        v = self.get(key)
+        if v is None:
+            raise KeyError(key)
+        return v
+
+    def items(self):
+        """Iterate over all (key, value) pairs, by scanning the records that follow the slot table."""
+        mm = self._mm
+        off = self._slotbase + (self._mask + 1) * self.slot.size
+        for i in range(self._n):
+            (kl, vl) = self.record.unpack_from(mm, off)
+            start = off + self.record.size
+            yield (mm[start:start+kl].decode("utf-8"), mm[start+kl:start+kl+vl].decode("utf-8"))
+            off = start + kl + vl
+
+    def keys(self):
+        for (k, v) in self.items():
+            yield k
+
+class ComposedTable(object):
+    """Composition of several mapping tables: the value associated with a key is found by
+translating it with the first table, translating the result with the second one, and so
+on. `hops' is a list of (table, keep) tuples: if a value is missing from a table, the
+translation fails if `keep' is False, otherwise the value is passed unchanged to the next
+table. Since the keys of the first table are known in advance, all translations are
+precomputed into a single direct table at creation time; the remaining tables are only
+kept if `keepFirst' is True, to translate keys that do not appear in the first one (keys
+that do appear in it, but whose translation fails, are remembered in `_failed')."""
+    _direct = None
+    _hops = None
+    _keepFirst = False
+    _failed = None
+
+    def __init__(self, first, hops, keepFirst=False, direct=None):
+        self._direct = {} if direct is None else direct
+        self._hops = hops
+        self._keepFirst = keepFirst
+        self._failed = set()
+        for (k, v) in first.items():
+            w = self.chain(str(v))
+            if w is not None:
+                self._direct[k] = w
+            elif keepFirst:
+                self._failed.add(k)
+        if not keepFirst:
+            self._hops = []
+
+    def chain(self, v):
+        """Translate `v' through all hops after the first one. Returns None if it fails."""
+        for (table, keep) in self._hops:
+            w = table.get(v)
+            if w is None:
+                if keep:
+                    continue
+                return None
+            v = str(w)
+        return v
+
+    def __len__(self):
+        return len(self._direct)
+
+    def get(self, key, default=None):
+        v = self._direct.get(key)
+        if v is None and self._keepFirst and key not in self._failed:
+            v = self.chain(key)
+        return default if v is None else v
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        v = self.get(key)
+        if v is None:
+            raise KeyError(key)
+        return v
+
+    def keys(self):
+        return self._direct.keys()
+
+    def items(self):
+        return self._direct.items()
+
+class RemoteTable(object):
+    """Client side of the lookup daemon started with --serve. Lookups are sent over the
+Unix socket at `path' in batches: each request is a JSON header line (describing the table
+and the size of the payload) followed by the keys, one per line; the response is a status
+line (`OK size' or `ERR message') followed by one line per key, containing `+' and the
+value, or `-' if the key is missing."""
+    _sock = None
+    _in = None
+    _spec = None
+
+    def __init__(self, path, spec):
+        self._spec = spec
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._sock.connect(path)
+        except socket.error as e:
+            sys.stderr.write("Error: cannot connect to assoc server on {}: {}\n".format(path, e))
+            sys.exit(1)
+        self._in = self._sock.makefile("rb")
+
+    def getMany(self, keys):
+        """Return the list of values associated with `keys' (None for missing ones)."""
+        payload = "".join([ k + "\n" for k in keys ]).encode("utf-8")
+        hdr = dict(self._spec, n=len(keys), size=len(payload))
+        self._sock.sendall((json.dumps(hdr) + "\n").encode("utf-8") + payload)
+        status = self._in.readline().decode("utf-8").rstrip("\n")
+        if not status.startswith("OK "):
+            sys.stderr.write("Error: assoc server: {}\n".format(status[4:] or "connection closed"))
+            sys.exit(1)
+        body = self._in.read(int(status[3:])).decode("utf-8")
+        result = []
+        for v in body.split("\n")[:len(keys)]:
+            result.append(v[1:] if v.startswith("+") else None)
+        return result
+
+    def get(self, key, default=None):
+        v = self.getMany([key])[0]
+        return default if v is None else v
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        v = self.get(key)
+        if v is None:
+            raise KeyError(key)
+        return v
+
+class AssocServer(object):
+    """Lookup daemon: keeps mapping tables resident in memory and answers batched lookup
+requests from RemoteTable clients over a Unix socket. Tables are loaded the first time a
+client asks for them, and reloaded if the mapping file changes."""
+    path = None
+    tables = {}                 # table spec -> (mtime, data)
+    locks = {}
+
+    def __init__(self, path):
+        self.path = path
+        self.tables = {}
+        self.locks = {}
+
+    async def getTable(self, spec):
+        key = tuple(sorted(spec.items()))
+        if key not in self.locks:
+            self.locks[key] = asyncio.Lock()
+        async with self.locks[key]:
+            filename = spec["filename"]
+            mtime = os.path.getmtime(filename) if os.path.isfile(filename) else None
+            entry = self.tables.get(key)
+            if entry is None or entry[0] != mtime:
+                A = Assoc.fromSpec(spec)
+                await asyncio.get_running_loop().run_in_executor(None, A.readTable)
+                entry = (mtime, A._data)
+                self.tables[key] = entry
+            return entry[1]
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                hdr = await reader.readline()
+                if not hdr:
+                    break
+                spec = json.loads(hdr.decode("utf-8"))
+                n = spec.pop("n")
+                payload = await reader.readexactly(spec.pop("size"))
+                keys = payload.decode("utf-8").split("\n")[:n]
+                try:
+                    data = await self.getTable(spec)
+                except Exception as e:
+                    writer.write("ERR {}\n".format(e).encode("utf-8"))
+                    await writer.drain()
+                    continue
+                out = []
+                for (k, v) in zip(keys, lookupMany(data, keys)):
+                    out.append("-" if v is None else "+" + str(v))
+                body = "".join([ w + "\n" for w in out ]).encode("utf-8")
+                writer.write("OK {}\n".format(len(body)).encode("utf-8") + body)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def main(self):
+        server = await asyncio.start_unix_server(self.handle, path=self.path)
+        sys.stderr.write("[Serving lookups on {}.]\n".format(self.path))
+        async with server:
+            await server.serve_forever()
+
+    def run(self, preload=None):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        if preload:
+            spec = preload.tableSpec()
+            mtime = os.path.getmtime(spec["filename"]) if os.path.isfile(spec["filename"]) else None
+            self.tables[tuple(sorted(spec.items()))] = (mtime, preload._data)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            asyncio.run(self.main())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+MISSING = object()
+
+def lookupMany(data, keys):
+    """Return the list of values associated with `keys' in `data', converted to strings
+(None for missing ones)."""
+    if hasattr(data, "getMany"):
+        return data.getMany(keys)
+    values = map(data.get, keys, repeat(MISSING))
+    return [ None if v is MISSING else str(v) for v in values ]
+
 class Assoc(object):
     filename = ""
     words = []
@@ -35,10 +516,24 @@ class Assoc(object):
     _exclude = False
     _interactive = False
     _whole = False
+    _index = False
+    column = None               # In join mode, column of input rows to translate
+    streamdelim = '\t'          # In join mode, delimiter of input rows
+    _append = False
+    _compact = False
+    _serve = None               # Socket path, if running as a lookup daemon
+    _client = None              # Socket path of the lookup daemon to use
+    lookup = "exact"            # or "prefix" or "range"
+    _sorted = None              # Sorted list of keys, for prefix and range lookups
+    hops = []                   # Additional tables to compose with this one, as returned by parseHopSpec
+    _keepFirst = False          # With hops, pass keys missing from the first table to the next one
+    _wholeLast = False          # With hops, -w applies to the last table
+    _first = False              # If True, words on the command line use the first row for each key
     _data = {}
 
     def __init__(self, args):
         self.words = []
+        self.hops = []
         self._data = {}
         self.parseArgs(args)
 
@@ -57,7 +552,22 @@ class Assoc(object):
             elif prev == "-d":
                 self.delimiter = decodeDelimiter(a)
                 prev = ""
-            elif a in ["-i", "-o", "-m", "-d"]:
+            elif prev == "-c":
+                self.column = int(a) - 1
+                prev = ""
+            elif prev == "-D":
+                self.streamdelim = decodeDelimiter(a)
+                prev = ""
+            elif prev == "--serve":
+                self._serve = a
+                prev = ""
+            elif prev == "--client":
+                self._client = a
+                prev = ""
+            elif prev == "-H":
+                self.hops.append(parseHopSpec(a))
+                prev = ""
+            elif a in ["-i", "-o", "-m", "-d", "-c", "-D", "--serve", "--client", "-H"]:
                 prev = a
             elif a in ["-j", "-J"]:
                 self.mode = a
@@ -69,6 +579,18 @@ class Assoc(object):
                 self._interactive = True
             elif a == "-x":
                 self._exclude = True
+            elif a == "-a":
+                self._append = True
+            elif a == "--compact":
+                self._compact = True
+            elif a in ["--prefix", "--range"]:
+                self.lookup = a[2:]
+            elif a == "-K":
+                self._keepFirst = True
+            elif a == "--index":
+                self._index = True
+            elif a == "--first":
+                self._first = True
             elif self.filename:
                 self.words.append(a)
             else:
@@ -82,8 +604,82 @@ class Assoc(object):
 
         if not self.outcol:
             self.outcol = self.incol + 1
+        if self.hops:
+            self._wholeLast = self._whole
+            self._whole = False
+
+    @classmethod
+    def fromSpec(cls, spec):
+        """Create an Assoc object for the table described by `spec' (see tableSpec())."""
+        A = cls([])
+        A.filename = spec["filename"]
+        A.mode = spec["mode"]
+        A.incol = spec["incol"]
+        A.outcol = spec["outcol"]
+        A.delimiter = spec["delimiter"]
+        A._whole = spec["whole"]
+        A._compact = spec["compact"]
+        A._index = spec["index"]
+        return A
+
+    def tableSpec(self):
+        """Return a dictionary describing the mapping table and how to read it."""
+        filename = self.filename if self.mode == "-J" else os.path.abspath(self.filename)
+        return {"filename": filename, "mode": self.mode, "incol": self.incol, "outcol": self.outcol,
+                "delimiter": self.delimiter, "whole": self._whole, "compact": self._compact, "index": self._index}
+
+    def indexPath(self):
+        """Name of the index file for the current input and output columns."""
+        if self.mode == "-j":
+            return self.filename + ".json.aix"
+        return "{}.{}-{}.aix".format(self.filename, self.incol + 1, "w" if self._whole else self.outcol + 1)
+
+    def indexOptions(self):
+        return "\t".join([self.mode, str(self.incol), str(self.outcol), str(self._whole), self.delimiter])
 
     def readTable(self):
+        self.loadTable()
+        if self.hops:
+            self.composeHops()
+
+    def composeHops(self):
+        """Load the tables for the additional hops, and compose them with this one."""
+        hops = []
+        for (filename, incol, outcol, keep) in self.hops:
+            H = Assoc([])
+            H.filename = filename
+            H.incol = incol
+            H.outcol = outcol
+            H.delimiter = self.delimiter
+            H._compact = self._compact
+            H._index = self._index
+            hops.append([H, keep])
+        hops[-1][0]._whole = self._wholeLast
+        for h in hops:
+            h[0].readTable()
+        direct = CompactTable() if self._compact else None
+        self._data = ComposedTable(self._data, [ (H._data, keep) for (H, keep) in hops ], self._keepFirst, direct)
+        sys.stderr.write("[{} associations composed over {} tables.]\n".format(len(self._data), len(hops) + 1))
+
+    def loadTable(self):
+        if self._index and self.mode != "-J":
+            path = self.indexPath()
+            idx = TableIndex.open(path, self.filename, self.indexOptions())
+            if idx:
+                self._data = idx
+                sys.stderr.write("[{} associations read from index {}.]\n".format(len(idx), path))
+                return
+            self.parseTable()
+            try:
+                TableIndex.build(path, self.filename, self.indexOptions(), self._data)
+            except (IOError, OSError) as e:
+                sys.stderr.write("Warning: cannot write index {} ({}), using the table directly.\n".format(path, e.strerror or e))
+                return
+            sys.stderr.write("[Index written to {}.]\n".format(path))
+        else:
+            self.parseTable()
+
+    def parseTable(self):
         src = self.filename
         if self.mode == "-j":
             self.readJSONfile()
@@ -91,49 +687,184 @@ class Assoc(object):
             self.readJSON()
             src = "JSON string"
         else:
-            with open(self.filename, "r") as f:
-                c = csv.reader(f, delimiter=self.delimiter)
-                for line in c:
-                    if len(line) > 1 and line[0][0] != "#":
-                        if self._whole:
-                            self._data[line[self.incol]] = "\t".join(line)
-                        else:
-                            self._data[line[self.incol]] = line[self.outcol]
+            if self._compact:
+                self._data = CompactTable()
+            for (k, v) in self.iterRows():
+                self._data[k] = v
         sys.stderr.write("[{} associations read from {}.]\n".format(len(self._data), src))
 
-    def readJSONfile(self):
+    def iterRows(self):
+        """Iterate over the (key, value) pairs in the tab-delimited mapping file."""
+        with open(self.filename, "r") as f:
+            c = csv.reader(f, delimiter=self.delimiter)
+            for line in c:
+                if len(line) > 1 and line[0][0] != "#":
+                    if self._whole:
+                        yield (line[self.incol], "\t".join(line))
+                    else:
+                        yield (line[self.incol], line[self.outcol])
+
+    def readTableFor(self, words):
+        """Like readTable(), but only retain the entries for the keys in `words'. As in
+readTable(), the last row for each key is used; if `_first' is set, the first one is used
+instead, and reading the mapping file stops as soon as all keys have been found."""
+        if self._index or self.mode == "-J":
+            return self.readTable()
+        wanted = set(words)
+        pairs = self.iterJSONfile() if self.mode == "-j" else self.iterRows()
+        if not self._first:
+            for (k, v) in pairs:
+                if k in wanted:
+                    self._data[k] = v
+        else:
+            for (k, v) in pairs:
+                if k in wanted:
+                    self._data[k] = v
+                    wanted.discard(k)
+                    if not wanted:
+                        break
+        sys.stderr.write("[{} of {} words found in {}.]\n".format(len(self._data), len(set(words)), self.filename))
+
+    def iterJSONfile(self):
+        """Iterate over the (key, value) pairs in the JSON mapping file."""
         with open(self.filename, "r") as f:
-            self._data = json.load(f)
+            for pair in iterJSONPairs(f):
+                yield pair
+
+    def readJSONfile(self):
+        if self._compact:
+            self._data = CompactTable()
+        for (k, v) in self.iterJSONfile():
+            self._data[k] = v
 
     def readJSON(self):
         self._data = json.loads(self.filename)
 
+    def sortKeys(self):
+        """Build the sorted array of keys used for prefix and range lookups."""
+        self._sorted = sorted(self._data.keys())
+
+    def matchKeys(self, query):
+        """Return the keys matching `query' in prefix or range mode, in sorted order. In range
+mode, `query' should contain the lower and upper bounds (inclusive) separated by whitespace.
+An empty query, or a range query without exactly two bounds, matches no keys."""
+        keys = self._sorted
+        if not query:
+            return []
+        if self.lookup == "prefix":
+            i = bisect_left(keys, query)
+            j = i
+            while j < len(keys) and keys[j].startswith(query):
+                j += 1
+        else:
+            bounds = query.split()
+            if len(bounds) != 2:
+                return []
+            i = bisect_left(keys, bounds[0])
+            j = bisect_right(keys, bounds[1], i)
+        return keys[i:j]
+
+    def decode_m(self, queries):
+        """Translate prefix or range queries, writing the values of all matching keys."""
+        out = []
+        for q in queries:
+            matches = self.matchKeys(q)
+            if matches:
+                out.extend(lookupMany(self._data, matches))
+            elif self._exclude:
+                continue
+            elif self._preserve:
+                out.append(q)
+            else:
+                out.append(self._missing)
+        if out:
+            sys.stdout.write("\n".join(out) + "\n")
+
+    def decode_ms(self):
+        """Translate prefix or range queries read from standard input."""
+        try:
+            for block in readBlocks(sys.stdin):
+                self.decode_m([ line.strip() for line in block ])
+        except IOError:
+            return
+        except KeyboardInterrupt:
+            return
+
     def decode(self):
+        """Translate the identifiers read from standard input, one per line. Input is read
+in large blocks, each block is translated with a single bulk lookup, and the results
+are written with a single write."""
         try:
-            for line in sys.stdin:
-                line = line.strip()
-                #print("/" + line + "/")
-                #print(line in self._data)
-                #input()
-                if line in self._data:
-                    w = str(self._data[line])
-                elif self._exclude:
-                    continue
+            for block in readBlocks(sys.stdin):
+                keys = [ line.strip() for line in block ]
+                values = lookupMany(self._data, keys)
+                if self._exclude:
+                    out = [ v for v in values if v is not None ]
                 elif self._preserve:
-                    w = line
+                    out = [ k if v is None else v for (k, v) in zip(keys, values) ]
                 else:
-                    w = self._missing
-                try:
-                    sys.stdout.write(w + "\n")
-                except IOError:
-                    return
+                    m = self._missing
+                    out = [ m if v is None else v for v in values ]
+                if out:
+                    sys.stdout.write("\n".join(out) + "\n")
+        except IOError:
+            return
+        except KeyboardInterrupt:
+            return
+
+    def decode_c(self):
+        """Join mode: read delimited rows from standard input and translate the value in
+column `column', replacing it (or appending the translation as a new column if -a was
+specified). Input and output are processed in large blocks."""
+        d = self.streamdelim
+        c = self.column
+        whole = self._whole or self._wholeLast  # values are whole lines, tab-delimited
+        try:
+            for block in readBlocks(sys.stdin):
+                rows = []
+                for line in block:
+                    line = line.rstrip("\r\n")
+                    if line.startswith("#"):
+                        rows.append(line)
+                        continue
+                    fields = line.split(d)
+                    if c >= len(fields):
+                        fields.extend([""] * (c + 1 - len(fields)))
+                    rows.append(fields)
+                keys = [ r[c] for r in rows if isinstance(r, list) ]
+                values = iter(lookupMany(self._data, keys))
+                out = []
+                for fields in rows:
+                    if not isinstance(fields, list):
+                        out.append(fields)
+                        continue
+                    v = next(values)
+                    if v is not None:
+                        w = str(v)
+                        if whole and d != "\t":
+                            w = d.join(w.split("\t"))
+                    elif self._exclude:
+                        continue
+                    elif self._preserve:
+                        w = fields[c]
+                    else:
+                        w = self._missing
+                    if self._append:
+                        fields.append(w)
+                    else:
+                        fields[c] = w
+                    out.append(d.join(fields))
+                if out:
+                    sys.stdout.write("\n".join(out) + "\n")
+        except IOError:
+            return
         except KeyboardInterrupt:
             return
 
     def decode_w(self):
-        for v in self.words:
-            if v in self._data:
-                w = str(self._data[v])
+        for (v, t) in zip(self.words, lookupMany(self._data, self.words)):
+            if t is not None:
+                w = str(t)
             elif self._preserve:
                 w = v
             else:
@@ -181,13 +912,27 @@ in the translation table, the program prints the missing value tag (set with -m)
 unless -p is specified, in which case the original identifier is printed unchanged.
 If no words are specified, the program reads them from standard input. 
 
+When words are specified on the command line, only the entries for those words are
+kept in memory, and the mapping file is read only until all of them have been found
+(so if a word appears more than once in the input column, its first occurrence is used).
+
 if -j is specified, the mapping file is assumed to be in JSON format. It should contain
-a single, flat dictionary mapping keys to values, e.g.: {{"a": 1, "b": 2}}. If -J is 
+a single, flat dictionary mapping keys to values, e.g.: {{"a": 1, "b": 2}}. The file is
+parsed incrementally, so it is never held in memory as a whole. If -J is 
 specified, the JSON dictionary is supplied on the command line in place of the filename 
 argument, e.g.:
 
     assoc.py -J '{{"a": 1, "b": 2}}' other arguments...
 
+Lookups can also be served by a resident daemon, so that mapping tables are loaded 
+only once per host. Start the daemon with:
+
+    assoc.py --serve SOCKET [options] [filename]
+
+where SOCKET is the path of a Unix socket (filename, if specified, is loaded immediately).
+Then use --client SOCKET in later invocations: all other options are the same, but the
+table is loaded and kept in memory by the daemon, and words are sent to it in batches.
+
 Options:
 
   -i I | Set input column to I (1-based). Default: {}.
@@ -199,8 +944,38 @@ Options:
   -x   | Exclude mode: if an input string has no translation, output nothing.
   -w   | Whole-line mode: output is the whole line associated with the identifier.
   -r   | Interactive mode.
+  -c C | Join mode: read delimited rows from standard input and translate the
+         value in their column C, writing the rows to standard output.
+  -a   | In join mode, append the translation as a new column instead of replacing
+         the original value. With -w, all the columns of the matching line are appended
+         (separated by the -D delimiter).
+  -D D | In join mode, set the delimiter of the input rows to D. Default: tab.
+  --compact | Store the mapping in a compact form, using much less memory for large
+         tables (at the cost of slightly slower lookups).
   -j   | Input file is in JSON format.
+  -H S | Compose the mapping with the table described by S, which has the form
+         filename[:I[:O]][:keep], where I and O are the input and output columns
+         (default: 1 and I+1). Can be repeated to chain several tables. If :keep is
+         specified, values missing from this table are passed unchanged to the next
+         one; otherwise the translation fails. With -w, the whole line of the last
+         table is returned.
+  -K   | With -H, pass words missing from the first table unchanged to the next one.
+  --prefix | Prefix mode: each input word is translated to the values of all
+         keys that start with it (one per line). An empty word matches nothing.
+  --range  | Range mode: each input line should contain two words LOW and HIGH
+         (separated by whitespace), and is translated to the values of all keys
+         k such that LOW <= k <= HIGH (one per line). On the command line, 
+         words are taken in pairs. Empty lines, and lines that do not contain
+         exactly two words, are treated as missing words.
+  --serve S  | Run as a lookup daemon listening on Unix socket S.
+  --client S | Look words up using the daemon listening on Unix socket S.
   -J   | First argument is a JSON string.
+  --first | When translating words given on the command line, use the first row for
+         each key instead of the last one, and stop reading the mapping file as soon
+         as all words have been found.
+  --index | Use a persistent index of the mapping file, stored next to it (in a file
+         ending in .aix). The index is built the first time, and rebuilt whenever the
+         mapping file changes. Later runs open it without reading the mapping file.
 
 Examples:
 
@@ -213,6 +988,15 @@ while
 
 will map the contents of column 2 of file to the contents of column 3 of the input.
 
+  assoc.py -c 4 -a file < data.tsv
+
+will append to each row of data.tsv the translation of the value in its fourth column.
+
+  assoc.py tx2gene.tsv -H gene2sym.tsv -H sym2path.tsv:1:3
+
+will map transcripts to genes, genes to symbols, and symbols to pathways (column 3 of
+sym2path.tsv) in a single pass.
+
 """.format(Assoc.incol, Assoc.outcol, Assoc._missing))
     sys.exit(0)
 
@@ -221,9 +1005,38 @@ if __name__ == "__main__":
     if len(args) == 0 or "-h" in args or "--help" in args:
         usage()
     A = Assoc(args)
-    A.readTable()
-    if A._interactive:
+    if A.hops and (A._serve or A._client):
+        sys.stderr.write("Error: -H cannot be used with --serve or --client.\n")
+        sys.exit(1)
+    if A._serve:
+        if A.filename:
+            A.readTable()
+        AssocServer(A._serve).run(preload=A if A.filename else None)
+        sys.exit(0)
+    if A._client:
+        if A.lookup != "exact":
+            sys.stderr.write("Error: --prefix and --range cannot be used with --client.\n")
+            sys.exit(1)
+        A._data = RemoteTable(A._client, A.tableSpec())
+    elif A.words and not A._interactive and A.lookup == "exact" and not A.hops:
+        A.readTableFor(A.words)
+    else:
+        A.readTable()
+    if A.lookup != "exact":
+        A.sortKeys()
+        if A.words:
+            if A.lookup == "range":
+                if len(A.words) % 2:
+                    sys.stderr.write("Error: --range requires an even number of words (LOW HIGH pairs), `{}' has no upper bound.\n".format(A.words[-1]))
+                    sys.exit(1)
+                A.words = [ A.words[i] + " " + A.words[i+1] for i in range(0, len(A.words) - 1, 2) ]
+            A.decode_m(A.words)
+        else:
+            A.decode_ms()
+    elif A._interactive:
         A.decode_i()
+    elif A.column is not None:
+        A.decode_c()
     elif A.words:
         A.decode_w()
     else:
@@ -14,12 +14,257 @@ __copyright__ = "Copyright 2018, University of Florida Research Foundation"
 
 import sys
 import gzip
+import math
+import heapq
+import struct
+import hashlib
+import tempfile
+from array import array
 import os.path
+from Compact import CompactKeys
+
+def hash128(e):
+    """Return two independent 64-bit hashes of string `e'."""
+    if not isinstance(e, bytes):
+        e = e.encode("utf-8")
+    return struct.unpack("<QQ", hashlib.md5(e).digest())
+
+class HyperLogLog():
+    """HyperLogLog cardinality sketch with 2**p registers."""
+    p = 14
+    m = 0
+    registers = None
+
+    def __init__(self, p=14):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(self.m)
+
+    def add(self, h):
+        """Add a 64-bit hash value to the sketch."""
+        q = 64 - self.p
+        idx = h >> q
+        rank = q - (h & ((1 << q) - 1)).bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def merge(self, other):
+        """Merge sketch `other' (built with the same p) into this one."""
+        regs = self.registers
+        for i in range(self.m):
+            if other.registers[i] > regs[i]:
+                regs[i] = other.registers[i]
+
+    def count(self):
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        est = alpha * m * m / sum([ 2.0 ** -r for r in self.registers ])
+        if est <= 2.5 * m:
+            zeros = self.registers.count(0)
+            if zeros:
+                est = m * math.log(float(m) / zeros)
+        return est
+
+    def stderr(self):
+        """Relative standard error of the estimate."""
+        return 1.04 / math.sqrt(self.m)
+
+class MinHash():
+    """Bottom-k MinHash sketch: retains the k smallest distinct hash values seen."""
+    k = 1024
+    _heap = None                # max-heap of negated hash values
+    _members = None
+
+    def __init__(self, k=1024):
+        self.k = k
+        self._heap = []
+        self._members = set()
+
+    def add(self, h):
+        """Add a 64-bit hash value to the sketch."""
+        if h in self._members:
+            return
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, -h)
+            self._members.add(h)
+        elif h < -self._heap[0]:
+            old = -heapq.heapreplace(self._heap, -h)
+            self._members.discard(old)
+            self._members.add(h)
+
+    def merge(self, other):
+        """Merge sketch `other' into this one."""
+        for h in other._members:
+            self.add(h)
+
+    def __contains__(self, h):
+        return h in self._members
+
+    def values(self):
+        return sorted(self._members)
+
+class CompactStore(CompactKeys):
+    """Compact map from strings to integer bitmasks: a CompactKeys with the mask of each key
+in a parallel typed array. This uses about half the memory of an equivalent dict of str
+to int. Masks are 64-bit; if a mask with more bits is added (more than 64 filespecs),
+they are moved to a list of Python ints."""
+    _masks = None               # mask of each key
+
+    def __init__(self, size=1024):
+        CompactKeys.__init__(self, size)
+        self._masks = array('Q')
+
+    def add(self, key, bits):
+        """OR `bits' into the mask for `key', adding the key if necessary. Returns True if
+the mask changed."""
+        if bits > 0xFFFFFFFFFFFFFFFF and isinstance(self._masks, array):
+            self._masks = list(self._masks)
+        (i, new) = self.insert(key)
+        if new:
+            self._masks.append(bits)
+            return True
+        old = self._masks[i]
+        self._masks[i] = old | bits
+        return old | bits != old
+
+    def get(self, key, default=None):
+        i = self.lookup(key)
+        return default if i == -1 else self._masks[i]
+
+    def __contains__(self, key):
+        return self.lookup(key) != -1
+
+    def items(self):
+        """Iterate over (key, mask) pairs in insertion order."""
+        return zip(self.keys(), self._masks)
+
+    def maskCounts(self):
+        """Return a dictionary mapping each distinct mask to the number of keys that have it."""
+        freqs = {}
+        for m in self._masks:
+            freqs[m] = freqs.get(m, 0) + 1
+        return freqs
+
+class SortedRun():
+    """A sorted, deduplicated list of elements stored one per line in a temporary file."""
+    path = None
+    n = 0
+
+    def __init__(self, path, n):
+        self.path = path
+        self.n = n
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        with open(self.path, "r") as f:
+            for line in f:
+                yield line.rstrip("\n")
+
+    def tagged(self, key, tag):
+        """Iterate over (key, element, tag) tuples, for merging with other runs."""
+        for e in self:
+            yield (key(e), e, tag)
+
+    def remove(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+class ColumnCache():
+    """Persistent cache of extracted column sets. Each set is stored in `directory' as a
+binary file containing a header (source size, source mtime, number of elements) followed
+by the sorted elements, UTF-8 encoded and newline-separated. Entries are invalidated when
+the size or mtime of the source file changes. When the total size of the cache exceeds
+`maxsize' bytes, the least recently used entries are deleted."""
+    directory = None
+    maxsize = 0                 # 0 means no limit
+    magic = b"CLX1"
+    header = struct.Struct("<4sQdQ")
+
+    def __init__(self, directory, maxsize=0):
+        self.directory = directory
+        self.maxsize = maxsize
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def entryPath(self, filename, col, delchar, ignchar, case):
+        key = "\t".join([os.path.abspath(filename), str(col), delchar, ignchar, "F" if case else "-"])
+        return os.path.join(self.directory, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".colx")
+
+    def load(self, filename, col, delchar, ignchar, case):
+        """Return the cached set for the specified column, or None if not cached or stale."""
+        path = self.entryPath(filename, col, delchar, ignchar, case)
+        if not os.path.isfile(path):
+            return None
+        st = os.stat(filename)
+        with open(path, "rb") as f:
+            hdr = f.read(self.header.size)
+            if len(hdr) < self.header.size:
+                return None
+            (magic, size, mtime, n) = self.header.unpack(hdr)
+            if magic != self.magic or size != st.st_size or mtime != st.st_mtime:
+                stale = True
+            else:
+                stale = False
+                payload = f.read()
+        if stale:
+            os.remove(path)
+            return None
+        os.utime(path, None)    # mark as recently used
+        if n == 0:
+            return set()
+        return set(payload.decode("utf-8").split("\n"))
+
+    def store(self, filename, col, delchar, ignchar, case, elements):
+        path = self.entryPath(filename, col, delchar, ignchar, case)
+        st = os.stat(filename)
+        (fd, tmp) = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as out:
+            out.write(self.header.pack(self.magic, st.st_size, st.st_mtime, len(elements)))
+            out.write("\n".join(sorted(elements)).encode("utf-8"))
+        os.rename(tmp, path)
+        self.evict()
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits in `maxsize' bytes."""
+        if not self.maxsize:
+            return
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if name.endswith(".colx"):
+                path = os.path.join(self.directory, name)
+                st = os.stat(path)
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        entries.sort()
+        for (mtime, size, path) in entries:
+            if total <= self.maxsize:
+                break
+            os.remove(path)
+            total -= size
+
+def parseSize(s):
+    """Parse a size in bytes, with optional K, M or G suffix."""
+    mult = 1
+    u = s[-1:].upper()
+    if u and u in "KMG":
+        mult = 1024 ** ("KMG".index(u) + 1)
+        s = s[:-1]
+    return int(s) * mult
+
+def identity(x):
+    return x
+
+def numericKey(x):
+    return (float(x), x)
 
 class Colx():
     current = None
     newlist = None
-    multidc = {}
+    multidc = None              # CompactStore mapping elements to file bitmasks in multi mode
+    membership = None           # In multi mode, write element-by-file membership matrix to this file
     mode = 'i'                  # 'd' for difference, '-u' for union
     isFirst = True
     ignchar = '#'
@@ -29,18 +274,31 @@ class Colx():
     quiet = False
     sort = False                # Value is a string, if it contains 'n', sort numerically, if it contains 'r', reverse.
     multi = False
+    matrix = False              # If True, report pairwise intersection and Jaccard matrices (implies multi)
     case = False                # If True, case insensitive.
-    
+    approx = False              # If True, estimate result sizes from sketches.
+    sketchsize = 1024           # Number of hashes retained by each MinHash sketch
+    sketches = []               # List of (mode, HyperLogLog, MinHash) in approx mode
+    external = False            # If True, use on-disk sorted runs instead of in-memory sets.
+    tmpdir = None               # Directory for run files (default: system temp directory)
+    runsize = 1000000           # Maximum number of elements held in memory per run
+    fanin = 64                  # Maximum number of runs merged at once
+    extruns = []                # List of SortedRun for each filespec in external multi mode
+    _runfiles = []              # Paths of all run files created, for cleanup
+    cache = None                # ColumnCache, if enabled
+
     def __init__(self):
         self.current = set()
         self.newlist = set()
         self.multi = {}
+        self.multidc = CompactStore()
+        self.sketches = []
+        self.extruns = []
+        self._runfiles = []
         self.isFirst = True
 
-    def addColumn(self, filename, col):
-        # print "entering: {}".format(len(self.current))
-        n = 0
-        self.newlist = set()
+    def readColumn(self, filename, col):
+        """Iterate over the non-empty elements in column `col' of `filename'."""
         fn_open = gzip.open if filename.endswith('.gz') else open
         with fn_open(filename, "r") as f:
             for line in f:
@@ -50,7 +308,24 @@ class Colx():
                     if e != '':
                         if self.case:
                             e = e.upper()
-                        self.newlist.add(e)
+                        yield e
+
+    def readSet(self, filename, col):
+        """Return the set of distinct elements in column `col' of `filename', using the
+cache if enabled."""
+        if self.cache:
+            key = (filename, col, self.delchar, self.ignchar, self.case)
+            data = self.cache.load(*key)
+            if data is None:
+                data = set(self.readColumn(filename, col))
+                self.cache.store(*(key + (data,)))
+            return data
+        return set(self.readColumn(filename, col))
+
+    def addColumn(self, filename, col):
+        # print "entering: {}".format(len(self.current))
+        n = 0
+        self.newlist = self.readSet(filename, col)
 
         n = len(self.newlist)
 
@@ -102,38 +377,321 @@ class Colx():
         return n
 
     def addColumnMulti(self, filename, col, idx):
+        """Add the elements in column `col' of `filename' to the multi-mode store with bit
+`idx'. Returns the number of distinct elements."""
         m = self.multidc
         n = 0
-        fn_open = gzip.open if filename.endswith('.gz') else open
-        with fn_open(filename, "r") as f:
-            for line in f:
-                if not line.startswith(self.ignchar):
-                    parsed = line.rstrip("\r\n").split(self.delchar)
-                    e = parsed[col]
-                    if e != '':
-                        n += 1
-                        if self.case:
-                            e = e.upper()
-                        if e in m:
-                            m[e] = m[e] | idx
-                        else:
-                            m[e] = idx
+        source = self.readSet(filename, col) if self.cache else self.readColumn(filename, col)
+        for e in source:
+            if m.add(e, idx):
+                n += 1
         return n
 
+    def addColumnApprox(self, filename, col):
+        """Build HyperLogLog and MinHash sketches for the elements in column `col' of `filename'.
+Memory use is constant regardless of the size of the input. Returns the estimated number of
+distinct elements."""
+        hll = HyperLogLog()
+        mh = MinHash(self.sketchsize)
+        for e in self.readColumn(filename, col):
+            (h1, h2) = hash128(e)
+            hll.add(h1)
+            mh.add(h2)
+        self.sketches.append((self.mode, hll, mh))
+        return int(round(hll.count()))
+
+    def _approxSample(self):
+        """Combine all sketches into a sketch of the union of all inputs. Returns a tuple
+(union size, standard error of union size, sample), where sample is a list of membership
+lists, one for each hash in the bottom-k sketch of the union."""
+        hll = HyperLogLog()
+        mh = MinHash(self.sketchsize)
+        for (mode, h, m) in self.sketches:
+            hll.merge(h)
+            mh.merge(m)
+        sample = [ [ h in s[2] for s in self.sketches ] for h in mh.values() ]
+        if len(sample) < self.sketchsize:
+            # The sketch holds the whole union, so the sample is exhaustive.
+            return (len(sample), 0.0, sample)
+        u = hll.count()
+        return (u, u * hll.stderr(), sample)
+
+    def _approxEstimate(self, hits, total, u, se):
+        """Scale the fraction `hits'/`total' of the union sample by the union size `u'. Returns
+the estimate and the half-width of its 95% confidence interval."""
+        if total == 0:
+            return (0, 0)
+        f = float(hits) / total
+        if se == 0:
+            return (int(round(f * u)), 0)
+        if hits == 0:
+            # Rule of three: upper bound of the 95% interval when nothing was sampled.
+            return (0, int(math.ceil(3.0 * u / total)))
+        sef = math.sqrt(f * (1 - f) / total)
+        err = 1.96 * math.sqrt((f * se) ** 2 + (u * sef) ** 2)
+        return (int(round(f * u)), int(math.ceil(err)))
+
+    def reportApprox(self):
+        """Estimate the size of the result of the sequence of set operations. Returns a tuple
+(estimate, error)."""
+        (u, se, sample) = self._approxSample()
+        hits = 0
+        for members in sample:
+            inset = members[0]
+            for i in range(1, len(members)):
+                mode = self.sketches[i][0]
+                if mode == 'i':
+                    inset = inset and members[i]
+                elif mode == 'd':
+                    inset = inset and not members[i]
+                elif mode == 'u':
+                    inset = inset or members[i]
+            if inset:
+                hits += 1
+        return self._approxEstimate(hits, len(sample), u, se)
+
+    def approxMasks(self):
+        """Returns a tuple (union size, standard error of union size, masks), where masks contains
+the membership mask of each element in the sample of the union."""
+        (u, se, sample) = self._approxSample()
+        masks = []
+        for members in sample:
+            mask = 0
+            bit = 1
+            for m in members:
+                if m:
+                    mask |= bit
+                bit *= 2
+            masks.append(mask)
+        return (u, se, masks)
+
+    def reportMultiApprox(self, multimap, idx):
+        (u, se, masks) = self.approxMasks()
+        for i in range(3, idx):
+            if not i in multimap:
+                hits = 0
+                for mask in masks:
+                    if (mask & i) == i:
+                        hits += 1
+                (n, err) = self._approxEstimate(hits, len(masks), u, se)
+                files = decodeBitmask(multimap, i)
+                sys.stdout.write("{}: ~{} (+/- {})\n".format(files, n, err))
+
     def reportMulti(self, multimap, idx):
         # print self.multidc
+        self.reportMaskCounts(multimap, idx, self.multidc.maskCounts())
+
+    def reportMaskCounts(self, multimap, idx, freqs):
+        """Print the number of elements shared by each combination of filespecs, given the
+number of elements having each membership mask."""
         for i in range(3, idx): # we don't care about 1 and 2
             if not i in multimap:
                 n = 0
-                for item in self.multidc.keys():
-                    count = self.multidc[item]
-                    if (count & i) == i:
-                        n += 1
+                for (mask, count) in freqs.items():
+                    if (mask & i) == i:
+                        n += count
                 files = decodeBitmask(multimap, i)
                 sys.stdout.write("{}: {}\n".format(files, n))
+
+    def writeMatrix(self, stream, multimap, idx, freqs, scale=1.0):
+        """Write the NxN matrices of pairwise intersection sizes and Jaccard indices between
+all filespecs, computed from the number of elements having each membership mask. Counts
+are multiplied by `scale' (used to extrapolate from a sample in approx mode)."""
+        bits = []
+        b = 1
+        while b < idx:
+            bits.append(b)
+            b *= 2
+        nf = len(bits)
+        inter = [ [0]*nf for i in range(nf) ]
+        for (mask, count) in freqs.items():
+            present = [ i for i in range(nf) if mask & bits[i] ]
+            for i in present:
+                row = inter[i]
+                for j in present:
+                    row[j] += count
+        labels = [ multimap[b] for b in bits ]
+        stream.write("Intersection\t" + "\t".join(labels) + "\n")
+        for i in range(nf):
+            stream.write(labels[i] + "\t" + "\t".join([ str(int(round(x * scale))) for x in inter[i] ]) + "\n")
+        stream.write("\nJaccard\t" + "\t".join(labels) + "\n")
+        for i in range(nf):
+            jac = []
+            for j in range(nf):
+                union = inter[i][i] + inter[j][j] - inter[i][j]
+                jac.append("{:.4f}".format(float(inter[i][j]) / union if union else 0.0))
+            stream.write(labels[i] + "\t" + "\t".join(jac) + "\n")
+
+    def reportMatrix(self, multimap, idx):
+        scale = 1.0
+        if self.approx:
+            (u, se, masks) = self.approxMasks()
+            freqs = {}
+            for m in masks:
+                freqs[m] = freqs.get(m, 0) + 1
+            if masks:
+                scale = float(u) / len(masks)
+        elif self.external:
+            freqs = self.externalMaskCounts()
+        else:
+            freqs = self.multidc.maskCounts()
+        if self.outfile:
+            with open(self.outfile, "w") as out:
+                self.writeMatrix(out, multimap, idx, freqs, scale)
+        else:
+            self.writeMatrix(sys.stdout, multimap, idx, freqs, scale)
+
+    def writeMembership(self, multimap, idx):
+        """Write the element-by-file membership matrix to the file in the `membership' attribute,
+streaming it from the compact store."""
+        bits = []
+        b = 1
+        while b < idx:
+            bits.append(b)
+            b *= 2
+        with open(self.membership, "w") as out:
+            out.write("Element\t" + "\t".join([ multimap[b] for b in bits ]) + "\n")
+            for (e, mask) in self.multidc.items():
+                out.write(e + "\t" + "\t".join([ "1" if mask & b else "0" for b in bits ]) + "\n")
     
+    def _sortKey(self):
+        if self.sort and 'n' in self.sort:
+            return numericKey
+        return identity
+
+    def _reverse(self):
+        return bool(self.sort) and 'r' in self.sort
+
+    def _newRunFile(self):
+        (fd, path) = tempfile.mkstemp(prefix="colx.", suffix=".run", dir=self.tmpdir)
+        self._runfiles.append(path)
+        return (os.fdopen(fd, "w"), path)
+
+    def _writeRun(self, elements):
+        data = sorted(elements, key=self._sortKey(), reverse=self._reverse())
+        (out, path) = self._newRunFile()
+        with out:
+            for e in data:
+                out.write(e + "\n")
+        return SortedRun(path, len(elements))
+
+    def _mergeRuns(self, runs):
+        """K-way merge of sorted runs into a single sorted, deduplicated run. Input runs are
+deleted. Merges at most `fanin' runs at a time."""
+        key = self._sortKey()
+        while len(runs) > 1:
+            merged = []
+            for i in range(0, len(runs), self.fanin):
+                group = runs[i:i+self.fanin]
+                (out, path) = self._newRunFile()
+                n = 0
+                prev = None
+                with out:
+                    for (k, e, t) in heapq.merge(*[ r.tagged(key, 0) for r in group ], reverse=self._reverse()):
+                        if e != prev:
+                            out.write(e + "\n")
+                            n += 1
+                            prev = e
+                for r in group:
+                    r.remove()
+                merged.append(SortedRun(path, n))
+            runs = merged
+        return runs[0]
+
+    def extractSorted(self, filename, col):
+        """Extract the distinct elements of column `col' of `filename' into a sorted run,
+holding at most `runsize' elements in memory at any time."""
+        runs = []
+        buf = set()
+        for e in self.readColumn(filename, col):
+            buf.add(e)
+            if len(buf) >= self.runsize:
+                runs.append(self._writeRun(buf))
+                buf = set()
+        if buf or not runs:
+            runs.append(self._writeRun(buf))
+        return self._mergeRuns(runs)
+
+    def addColumnExternal(self, filename, col):
+        newrun = self.extractSorted(filename, col)
+        n = len(newrun)
+        if self.isFirst:
+            self.current = newrun
+            return n
+
+        key = self._sortKey()
+        (out, path) = self._newRunFile()
+        m = 0
+        prev = None
+        mask = 0
+        with out:
+            for (k, e, t) in heapq.merge(self.current.tagged(key, 1), newrun.tagged(key, 2), reverse=self._reverse()):
+                if e != prev:
+                    if prev is not None and self._keepMasked(mask):
+                        out.write(prev + "\n")
+                        m += 1
+                    prev = e
+                    mask = 0
+                mask |= t
+            if prev is not None and self._keepMasked(mask):
+                out.write(prev + "\n")
+                m += 1
+        self.current.remove()
+        newrun.remove()
+        self.current = SortedRun(path, m)
+        return n
+
+    def _keepMasked(self, mask):
+        """Decide whether an element belonging to the current result (bit 1) and/or to the
+new column (bit 2) belongs to the updated result."""
+        if self.mode == 'i':
+            return mask == 3
+        elif self.mode == 'd':
+            return mask == 1
+        else:
+            return True
+
+    def addColumnMultiExternal(self, filename, col):
+        run = self.extractSorted(filename, col)
+        self.extruns.append(run)
+        return len(run)
+
+    def externalMaskCounts(self):
+        """Stream a k-way merge of all runs, counting how many elements share each membership mask."""
+        key = self._sortKey()
+        freqs = {}
+        prev = None
+        mask = 0
+        tags = []
+        bit = 1
+        for r in self.extruns:
+            tags.append(r.tagged(key, bit))
+            bit *= 2
+        for (k, e, t) in heapq.merge(*tags, reverse=self._reverse()):
+            if e != prev:
+                if prev is not None:
+                    freqs[mask] = freqs.get(mask, 0) + 1
+                prev = e
+                mask = 0
+            mask |= t
+        if prev is not None:
+            freqs[mask] = freqs.get(mask, 0) + 1
+        return freqs
+
+    def reportMultiExternal(self, multimap, idx):
+        self.reportMaskCounts(multimap, idx, self.externalMaskCounts())
+
+    def cleanup(self):
+        """Delete all run files created in external mode."""
+        for path in self._runfiles:
+            if os.path.isfile(path):
+                os.remove(path)
+        self._runfiles = []
+
     def sortCurrent(self):
         """Sort the contents of the 'current' set according to the flags in the 'sort' attribute. Returns sorted values as list."""
+        if self.external:
+            return self.current   # already sorted on disk
         if self.sort:
             reverse = ('r' in self.sort)
             if 'n' in self.sort:
@@ -175,10 +733,20 @@ otherwise."""
         sys.stderr.write("Error: file {} does not exist or is not readable.\n".format(fs))
         return False
     
+def checkExternalSort(C, runsort):
+    """In external mode, runs are sorted according to the -s option in force when the first
+filespec is read: exit with an error if it was changed afterwards."""
+    if C.external and runsort is not None and C.sort != runsort:
+        sys.stderr.write("Error: in external mode, -s must be specified before the first filespec.\n")
+        sys.exit(1)
+
 def main(C, args):
     next = ""
     multimap = {}
     idx = 1
+    cachedir = None
+    cachemax = 0
+    runsort = None              # Value of -s when the first filespec was read in external mode
     for a in args:
         if next == '-o':
             C.outfile = a
@@ -194,8 +762,30 @@ def main(C, args):
         elif next == '-g':
             C.ignchar = a[0]
             next = ""
-        elif a in ['-o', '-c', '-g']:
+        elif next == '-k':
+            C.sketchsize = int(a)
+            next = ""
+        elif next == '-b':
+            C.runsize = int(a)
+            next = ""
+        elif next == '-T':
+            C.tmpdir = a
+            next = ""
+        elif next == '-C':
+            cachedir = a
+            next = ""
+        elif next == '--cache-max':
+            cachemax = parseSize(a)
+            next = ""
+        elif next == '--membership':
+            C.membership = a
+            next = ""
+        elif a in ['-o', '-c', '-g', '-k', '-b', '-T', '-C', '--cache-max', '--membership']:
             next = a
+        elif a == '--approx':
+            C.approx = True
+        elif a == '--external':
+            C.external = True
         elif a == '-w':
             C.write = True
         elif a == '-q':
@@ -204,25 +794,63 @@ def main(C, args):
             C.sort = a[1:]
         elif a == '-m':
             C.multi = True
+        elif a == '--matrix':
+            C.multi = True
+            C.matrix = True
         elif a == '-f':
             C.case = True
         elif a in ['-i', '-d', '-u']:
             C.mode = a[1:]
         else:
             fs = parseFilespec(a)
+            if fs and cachedir and not C.cache:
+                C.cache = ColumnCache(cachedir, cachemax)
             if fs:
-                if C.multi:
+                if C.external:
+                    checkExternalSort(C, runsort)
+                    runsort = C.sort
+                if C.approx:
+                    if C.multi:
+                        multimap[idx] = "{}:{}".format(fs[0], fs[1]+1)
+                        idx = idx * 2
+                    n = C.addColumnApprox(fs[0], fs[1])
+                elif C.multi:
                     multimap[idx] = "{}:{}".format(fs[0], fs[1]+1)
-                    n = C.addColumnMulti(fs[0], fs[1], idx)
+                    if C.external:
+                        n = C.addColumnMultiExternal(fs[0], fs[1])
+                    else:
+                        n = C.addColumnMulti(fs[0], fs[1], idx)
                     idx = idx * 2
+                elif C.external:
+                    n = C.addColumnExternal(fs[0], fs[1])
                 else:
                     n = C.addColumn(fs[0], fs[1])
                 C.isFirst = False
                 if n and not C.quiet:
-                    sys.stderr.write("{}:{}: {} elements\n".format(fs[0], fs[1]+1, n))
+                    sys.stderr.write("{}:{}: {}{} elements\n".format(fs[0], fs[1]+1, "~" if C.approx else "", n))
+    checkExternalSort(C, runsort)
 
-    if C.multi:
-        C.reportMulti(multimap, idx)
+    if C.matrix:
+        C.reportMatrix(multimap, idx)
+        if C.membership and not (C.approx or C.external):
+            C.writeMembership(multimap, idx)
+    elif C.approx:
+        if C.multi:
+            C.reportMultiApprox(multimap, idx)
+        elif C.sketches:
+            (n, err) = C.reportApprox()
+            if C.quiet:
+                sys.stdout.write(str(n) + "\n")
+            else:
+                label = {'d': 'Difference', 'u': 'Union'}.get(C.mode, 'Intersection')
+                sys.stderr.write("{}: ~{} elements (+/- {}, 95% CI)\n".format(label, n, err))
+    elif C.multi:
+        if C.external:
+            C.reportMultiExternal(multimap, idx)
+        else:
+            C.reportMulti(multimap, idx)
+            if C.membership:
+                C.writeMembership(multimap, idx)
     else:
         data = C.sortCurrent()
         if not C.quiet:
@@ -264,11 +892,37 @@ the final output are printed to standard error.
                converts all items to uppercase.
   -m         | Enable 'multi' mode. Will compute all pairwise intersections between
                all input columns. Disables -i, -d, -u.
+  --matrix   | Read each filespec once and print NxN tables of the pairwise
+               intersection sizes and Jaccard indices between all input columns
+               (to 'outfile' if -o is specified). Can be combined with --approx
+               and --external.
+  --membership file | In multi mode, write a matrix with one row per element and one
+               column per filespec to 'file', with 1 indicating that the element
+               appears in that filespec and 0 otherwise.
   -i         | Intersection mode. Result will consist of the intersection of all
                input columns. This is the default mode.
   -u         | Union mode. Result list includes all elements of all input columns.
   -d         | Difference mode. Result list includes elements in first list but
                not in successive lists.
+  --approx   | Approximate mode. Build a fixed-size HyperLogLog and MinHash sketch
+               for each filespec and report estimated result sizes with 95%
+               confidence intervals instead of the elements. Uses constant memory.
+               Can be combined with -m. Disables -w, -o, -s.
+  -k K       | Number of hashes kept in each MinHash sketch in approximate mode
+               (default: {}). Larger values give tighter estimates.
+  --external | External-memory mode. Extract each column into sorted, deduplicated
+               run files on disk and compute the result with a streaming merge.
+               Use this when the sets do not fit in memory. Output is always sorted
+               (alphabetically, unless -s specifies otherwise); -s must be given
+               before the first filespec.
+  -b N       | In external mode, hold at most N elements in memory (default: {}).
+  -T dir     | In external mode, write run files to directory 'dir' (default: system
+               temporary directory).
+  -C dir     | Cache the set extracted from each filespec in directory 'dir', and
+               reuse it in later runs as long as the file's size and modification
+               time are unchanged. Applies to the default and -m modes.
+  --cache-max S | Limit the size of the cache directory to S bytes (suffixes K, M, G
+               are allowed), deleting the least recently used entries first.
 
 Note that filespecs are processed in left-to-right order, and the mode can be changed
 any number of times while processing the files. For example, the following:
@@ -289,7 +943,7 @@ Full documentation and source code are available on GitHub:
 
 (c) 2016, A. Riva, DiBiG, ICBR Bioinformatics, University of Florida
 
-""")
+""".format(Colx.sketchsize, Colx.runsize))
 
             
 if __name__ == "__main__":
@@ -297,5 +951,9 @@ if __name__ == "__main__":
     if '-h' in args or '--help' in args:
         usage()
     else:
-        main(Colx(), args)
+        C = Colx()
+        try:
+            main(C, args)
+        finally:
+            C.cleanup()
         
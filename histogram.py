@@ -1,46 +1,710 @@
 #!/usr/bin/env python
 
+import io
+import os
 import sys
 import csv
+import locale
+import heapq
+import functools
+import multiprocessing
+import tempfile
+import numpy as np
 from numpy import histogram
-from collections import defaultdict
+from itertools import groupby
+from operator import itemgetter
+from collections import Counter
+
+def toFloatArray(values):
+    """Convert a list of strings to a NumPy array of floats, skipping the ones that
+are not valid numbers (as well as NaNs and infinities)."""
+    try:
+        a = np.array(values, dtype=float)
+    except ValueError:
+        good = []
+        for v in values:
+            try:
+                good.append(float(v))
+            except ValueError:
+                pass
+        a = np.array(good, dtype=float)
+    return a[np.isfinite(a)]
+
+def toFloatPairs(pairs):
+    """Convert a list of (x, y) pairs of strings to two NumPy arrays of floats, skipping the
+pairs in which either value is not a valid number (or is a NaN or infinity)."""
+    try:
+        a = np.array(pairs, dtype=float).reshape(-1, 2)
+    except ValueError:
+        good = []
+        for (x, y) in pairs:
+            try:
+                good.append((float(x), float(y)))
+            except ValueError:
+                pass
+        a = np.array(good, dtype=float).reshape(-1, 2)
+    a = a[np.isfinite(a).all(axis=1)]
+    return (a[:, 0], a[:, 1])
+
+def parseColumns(s):
+    """Parse a comma-separated list of 1-based column numbers, each optionally followed by
+`n' (numerical), `c' (categorical) or `q' (quantiles). Returns a list of (column, kind)
+tuples, with 0-based columns and kind set to None when not specified."""
+    result = []
+    for c in s.split(","):
+        kind = None
+        if c.endswith("n"):
+            kind = "quant"
+            c = c[:-1]
+        elif c.endswith("q"):
+            kind = "pct"
+            c = c[:-1]
+        elif c.endswith("c"):
+            kind = "cat"
+            c = c[:-1]
+        result.append((int(c) - 1, kind))
+    return result
+
+def writeRun(items):
+    """Write the (value, count) pairs in `items' to a new temporary file, returning its path."""
+    (fd, path) = tempfile.mkstemp(prefix="histogram-", suffix=".run")
+    with os.fdopen(fd, "w") as out:
+        w = csv.writer(out, delimiter='\t', lineterminator='\n')
+        for (v, c) in items:
+            w.writerow([v, c])
+    return path
+
+def readRun(path):
+    """Iterate over the (value, count) pairs in a file written by writeRun()."""
+    with open(path, "r") as f:
+        for (v, c) in csv.reader(f, delimiter='\t'):
+            yield (v, int(c))
+
+def mergeRange(a, b):
+    """Return the smallest (min, max) interval containing intervals `a' and `b', either of
+which may be (None, None)."""
+    if a[0] is None:
+        return b
+    if b[0] is None:
+        return a
+    return (min(a[0], b[0]), max(a[1], b[1]))
+
+def splitFile(filename, n):
+    """Split the file `filename' into `n' byte ranges of about the same size."""
+    size = os.path.getsize(filename)
+    return [ (i * size // n, (i + 1) * size // n) for i in range(n) ]
+
+def findRangesWorker(job):
+    (H, columns, span) = job
+    return H.findRanges(columns, span)
+
+def countWorker(job):
+    (H, span) = job
+    for rows in H.readBlocks(span):
+        H.addRows(rows)
+    return H.histos
+
+def parsePair(s):
+    """Parse a pair of 1-based column numbers separated by a comma, returning them 0-based."""
+    (x, y) = s.split(",")
+    return (int(x) - 1, int(y) - 1)
+
+def columnLabel(c):
+    """Return the label of column (or pair of columns) `c' for output."""
+    if isinstance(c, tuple):
+        return "{},{}".format(c[0] + 1, c[1] + 1)
+    return str(c + 1)
+
+def parseFloats(s):
+    return [ float(x) for x in s.split(",") ]
+
+def parseRange(s):
+    """Parse a string of the form min,max into a tuple of floats."""
+    (lo, hi) = s.split(",")
+    return (float(lo), float(hi))
+
+class QuantileSketch(object):
+    """KLL quantile sketch. Values are stored in a hierarchy of levels, where each value
+in level h stands for 2**h input values. When a level grows beyond its capacity it is
+sorted and compacted, by promoting every other value (starting at a random offset) to
+the next level. Memory use is O(k) regardless of the number of values, the rank error
+of quantile estimates is O(1/k), and sketches can be merged."""
+    k = 1000
+    n = 0
+    min = None
+    max = None
+    levels = []
+
+    def __init__(self, k=1000):
+        self.k = k
+        self.n = 0
+        self.levels = [ np.zeros(0) ]
+
+    def capacity(self, h):
+        depth = len(self.levels) - h - 1
+        return max(2, int(np.ceil(self.k * (2.0 / 3) ** depth)))
+
+    def add(self, values):
+        """Add the values in NumPy array `values' to the sketch."""
+        if not len(values):
+            return
+        self.n += len(values)
+        (lo, hi) = (values.min(), values.max())
+        self.min = lo if self.min is None else min(self.min, lo)
+        self.max = hi if self.max is None else max(self.max, hi)
+        self.levels[0] = np.concatenate((self.levels[0], values))
+        self.compress()
+
+    def merge(self, other):
+        if not other.n:
+            return
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.zeros(0))
+        for h in range(len(other.levels)):
+            self.levels[h] = np.concatenate((self.levels[h], other.levels[h]))
+        self.n += other.n
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self.compress()
+
+    def compress(self):
+        compacted = True
+        while compacted:
+            compacted = False
+            for h in range(len(self.levels)):
+                if len(self.levels[h]) > self.capacity(h):
+                    if h + 1 == len(self.levels):
+                        self.levels.append(np.zeros(0))
+                    a = np.sort(self.levels[h])
+                    keep = a[len(a) - len(a) % 2:]      # odd value out stays at this level
+                    a = a[:len(a) - len(keep)]
+                    self.levels[h+1] = np.concatenate((self.levels[h+1], a[np.random.randint(2)::2]))
+                    self.levels[h] = keep
+                    compacted = True
+
+    def items(self):
+        """Return the sorted values in the sketch, and their weights."""
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([ np.full(len(l), 2.0 ** h) for (h, l) in enumerate(self.levels) ])
+        order = np.argsort(values, kind="mergesort")
+        return (values[order], weights[order])
+
+    def quantiles(self, qs):
+        """Return the estimated values at quantiles `qs' (between 0 and 1)."""
+        if not self.n:
+            return [ float("nan") for q in qs ]
+        (values, weights) = self.items()
+        cw = np.cumsum(weights)
+        result = []
+        for q in qs:
+            if q <= 0:
+                result.append(self.min)
+            elif q >= 1:
+                result.append(self.max)
+            else:
+                i = min(np.searchsorted(cw, q * cw[-1]), len(values) - 1)
+                result.append(values[i])
+        return result
+
+    def histogram(self, nbins, rng=None):
+        """Estimate the histogram of the values with `nbins' bins over `rng' (default: from
+the minimum to the maximum value seen)."""
+        if not self.n:
+            return histogram([], bins=nbins, range=rng)
+        (values, weights) = self.items()
+        (counts, edges) = histogram(values, bins=nbins, range=rng or (self.min, self.max), weights=weights)
+        return (np.rint(counts).astype(np.int64), edges)
+
+class Percentiles(object):
+    """Summary of a numerical column: number of values, minimum, maximum, the specified
+percentiles, and interquartile range, estimated with a QuantileSketch."""
+    percentiles = []
+    sketch = None
+
+    def __init__(self, percentiles):
+        self.percentiles = percentiles
+        self.sketch = QuantileSketch()
+
+    def add(self, values):
+        self.sketch.add(toFloatArray(values))
+
+    def merge(self, other):
+        self.sketch.merge(other.sketch)
+
+    def report(self, out, order, prefix=""):
+        sk = self.sketch
+        pcts = [ p / 100.0 for p in self.percentiles ] + [ 0.25, 0.75 ]
+        values = sk.quantiles(pcts)
+        out.write("{}n\t{}\n".format(prefix, sk.n))
+        out.write("{}min\t{:f}\n".format(prefix, sk.min if sk.n else float("nan")))
+        for (p, v) in zip(self.percentiles, values):
+            out.write("{}p{:g}\t{:f}\n".format(prefix, p, v))
+        out.write("{}max\t{:f}\n".format(prefix, sk.max if sk.n else float("nan")))
+        out.write("{}IQR\t{:f}\n".format(prefix, values[-1] - values[-2]))
+
+class Categorical(object):
+    """Categorical histogram: number of occurrences of each distinct value."""
+    counts = None
+
+    def __init__(self):
+        self.counts = Counter()
+
+    def add(self, values):
+        self.counts.update(values)
+
+    def merge(self, other):
+        self.counts.update(other.counts)
+
+    def report(self, out, order, prefix=""):
+        counts = list(self.counts.items())
+        if order == "alpha":
+            counts.sort(key=lambda r: r[0])
+        elif order == "asc":
+            counts.sort(key=lambda r: r[1])
+        elif order == "desc":
+            counts.sort(key=lambda r: r[1], reverse=True)
+        for cnt in counts:
+            out.write("{}{}\t{}\n".format(prefix, cnt[0], cnt[1]))
+
+class TopK(object):
+    """Approximate K most frequent values, found with a Space-Saving summary of `size'
+counters (default: 10 * K). Each counter holds an upper bound on the number of
+occurrences of its value, and the maximum amount by which it may be overestimated. Any
+value occurring more than N / `size' times (where N is the total number of values) is
+guaranteed to be in the summary. Values are added one at a time, so memory use only
+depends on `size'; summaries computed by different workers are combined using the
+mergeable variant of the algorithm."""
+    k = 0
+    size = 0
+    counts = {}                 # value => (count, error)
+    _heap = []                  # one (count, value) entry per counter; count may be out of date
+
+    def __init__(self, k, size=None):
+        self.k = k
+        self.size = size or 10 * k
+        self.counts = {}
+        self._heap = []
+
+    def floor(self):
+        """Return an upper bound on the number of occurrences of values not in the summary."""
+        if len(self.counts) < self.size:
+            return 0
+        return min([ c for (c, e) in self.counts.values() ])
+
+    def combine(self, counts, floor):
+        myfloor = self.floor()
+        merged = {}
+        for (v, (c, e)) in self.counts.items():
+            (oc, oe) = counts.get(v, (floor, floor))
+            merged[v] = (c + oc, e + oe)
+        for (v, (c, e)) in counts.items():
+            if v not in merged:
+                merged[v] = (c + myfloor, e + myfloor)
+        if len(merged) > self.size:
+            merged = dict(heapq.nlargest(self.size, merged.items(), key=lambda r: r[1][0]))
+        self.counts = merged
+        self._heap = [ (c, v) for (v, (c, e)) in merged.items() ]
+        heapq.heapify(self._heap)
+
+    def evict(self):
+        """Remove the value with the smallest count from the summary, and return its count.
+Heap entries are not updated when counts grow, so stale ones are refreshed as they reach
+the top."""
+        heap = self._heap
+        counts = self.counts
+        while True:
+            (c, v) = heap[0]
+            current = counts[v][0]
+            if current == c:
+                heapq.heappop(heap)
+                del counts[v]
+                return c
+            heapq.heapreplace(heap, (current, v))
+
+    def add(self, values):
+        """Count each of `values': a value not in the summary when all counters are in use
+replaces the one with the smallest count, which becomes its error."""
+        counts = self.counts
+        heap = self._heap
+        for v in values:
+            if v in counts:
+                (c, e) = counts[v]
+                counts[v] = (c + 1, e)
+            elif len(counts) < self.size:
+                counts[v] = (1, 0)
+                heapq.heappush(heap, (1, v))
+            else:
+                m = self.evict()
+                counts[v] = (m + 1, m)
+                heapq.heappush(heap, (m + 1, v))
+
+    def merge(self, other):
+        self.combine(other.counts, other.floor())
+
+    def report(self, out, order, prefix=""):
+        top = heapq.nlargest(self.k, self.counts.items(), key=lambda r: r[1][0])
+        for (v, (c, e)) in top:
+            out.write("{}{}\t{}\t{}\n".format(prefix, v, c, e))
+
+class SpillingCategorical(Categorical):
+    """Exact categorical histogram for columns with a very large number of distinct values.
+Whenever there are more than `maxsize' distinct values in memory, their counts are written
+to a sorted temporary file; at the end, all files are merged. If `top' is specified,
+only the `top' most frequent values are reported."""
+    maxsize = 0
+    top = 0
+    runs = []                   # Paths of temporary files
+
+    def __init__(self, maxsize, top=0):
+        Categorical.__init__(self)
+        self.maxsize = maxsize
+        self.top = top
+        self.runs = []
+
+    def spill(self):
+        self.runs.append(writeRun(sorted(self.counts.items())))
+        self.counts = Counter()
+
+    def add(self, values):
+        self.counts.update(values)
+        if len(self.counts) > self.maxsize:
+            self.spill()
+
+    def merge(self, other):
+        self.runs.extend(other.runs)
+        other.runs = []
+        self.counts.update(other.counts)
+        if len(self.counts) > self.maxsize:
+            self.spill()
+
+    def items(self):
+        """Iterate over all (value, count) pairs in alphabetical order."""
+        streams = [ readRun(path) for path in self.runs ] + [ iter(sorted(self.counts.items())) ]
+        for (v, group) in groupby(heapq.merge(*streams), key=itemgetter(0)):
+            yield (v, sum([ c for (x, c) in group ]))
+
+    def sortedByCount(self, reverse):
+        """Iterate over all (value, count) pairs sorted by count, using temporary files
+of at most `maxsize' pairs each."""
+        key = (lambda r: (-r[1], r[0])) if reverse else (lambda r: (r[1], r[0]))
+        runs = []
+        batch = []
+        try:
+            for r in self.items():
+                batch.append(r)
+                if len(batch) == self.maxsize:
+                    runs.append(writeRun(sorted(batch, key=key)))
+                    batch = []
+            batch.sort(key=key)
+            for r in heapq.merge(*([ readRun(path) for path in runs ] + [ iter(batch) ]), key=key):
+                yield r
+        finally:
+            for path in runs:
+                os.remove(path)
+
+    def report(self, out, order, prefix=""):
+        if self.top:
+            for (v, c) in heapq.nlargest(self.top, self.items(), key=itemgetter(1)):
+                out.write("{}{}\t{}\t0\n".format(prefix, v, c))
+            return
+        if order == "alpha":
+            counts = self.items()
+        else:
+            counts = self.sortedByCount(order == "desc")
+        for (v, c) in counts:
+            out.write("{}{}\t{}\n".format(prefix, v, c))
+
+    def cleanup(self):
+        for path in self.runs:
+            if os.path.isfile(path):
+                os.remove(path)
+        self.runs = []
+
+class Numerical(object):
+    """Numerical histogram with `nbins' bins over the interval `rng'. Values are added in
+chunks to a running counts array. If `rng' is None, the values are instead kept (as
+arrays) until the end, and the interval is the one spanned by the data; or, if `sketch'
+is True, they are summarized in a QuantileSketch, from which the histogram is estimated;
+in this case the report starts with a header line marking the counts as estimates."""
+    nbins = 0
+    rng = None
+    counts = None
+    edges = None
+    estimated = False           # True if counts were estimated from a sketch
+    _chunks = None
+    _sketch = None
+
+    def __init__(self, nbins, rng=None, sketch=False):
+        self.nbins = nbins
+        self.rng = rng
+        self._chunks = []
+        if rng:
+            (self.counts, self.edges) = histogram([], bins=nbins, range=rng)
+        elif sketch:
+            self._sketch = QuantileSketch()
+
+    def add(self, values):
+        a = toFloatArray(values)
+        if self.rng:
+            self.counts += histogram(a, bins=self.nbins, range=self.rng)[0]
+        elif self._sketch:
+            self._sketch.add(a)
+        else:
+            self._chunks.append(a)
+
+    def merge(self, other):
+        if self._sketch:
+            self._sketch.merge(other._sketch)
+        elif self.counts is None:
+            self._chunks.extend(other._chunks)
+        else:
+            self.counts += other.counts
+
+    def bounds(self):
+        """Return the (minimum, maximum) of the values seen so far, or (None, None), if
+the interval of the histogram was not specified."""
+        if self._sketch:
+            return (self._sketch.min, self._sketch.max)
+        data = [ a for a in self._chunks if len(a) ]
+        if self.counts is not None or not data:
+            return (None, None)
+        return (min([ a.min() for a in data ]), max([ a.max() for a in data ]))
+
+    def finish(self, rng=None):
+        """Compute the histogram, if the interval was not specified at creation time: over
+`rng' if specified, otherwise over the interval spanned by the values."""
+        if self._sketch:
+            (self.counts, self.edges) = self._sketch.histogram(self.nbins, rng)
+            self.estimated = True
+            self._sketch = None
+        elif self.counts is None:
+            data = np.concatenate([ np.zeros(0) ] + self._chunks)
+            (self.counts, self.edges) = histogram(data, bins=self.nbins, range=rng)
+            self._chunks = []
+
+    def report(self, out, order, prefix=""):
+        self.finish()
+        if self.estimated:
+            out.write("#{}min\tmax\t~occurrences\n".format(prefix))
+        for i in range(len(self.counts)):
+            out.write("{}{:f}\t{:f}\t{}\n".format(prefix, self.edges[i], self.edges[i+1], self.counts[i]))
+
+class Joint(object):
+    """Two-dimensional histogram of pairs of values, with `nbins' x `nbins' bins over the
+intervals `xrng' and `yrng'. Pairs are added in chunks to a running counts matrix. If
+either interval is None, the pairs are instead kept (as arrays) until the end. If
+`matrix' is True, the histogram is reported as a matrix instead of in long format."""
+    nbins = 0
+    xrng = None
+    yrng = None
+    matrix = False
+    counts = None
+    xedges = None
+    yedges = None
+    _chunks = None
+
+    def __init__(self, nbins, xrng=None, yrng=None, matrix=False):
+        self.nbins = nbins
+        self.xrng = xrng
+        self.yrng = yrng
+        self.matrix = matrix
+        self._chunks = []
+        if xrng and yrng:
+            (self.counts, self.xedges, self.yedges) = self.histogram([], [], [xrng, yrng])
+
+    def histogram(self, x, y, rng):
+        (counts, xedges, yedges) = np.histogram2d(x, y, bins=self.nbins, range=rng)
+        return (counts.astype(np.int64), xedges, yedges)
+
+    def add(self, pairs):
+        (x, y) = toFloatPairs(pairs)
+        if self.counts is not None:
+            self.counts += self.histogram(x, y, [self.xrng, self.yrng])[0]
+        else:
+            self._chunks.append((x, y))
+
+    def merge(self, other):
+        if self.counts is None:
+            self._chunks.extend(other._chunks)
+        else:
+            self.counts += other.counts
+
+    def data(self):
+        x = np.concatenate([ np.zeros(0) ] + [ cx for (cx, cy) in self._chunks ])
+        y = np.concatenate([ np.zeros(0) ] + [ cy for (cx, cy) in self._chunks ])
+        return (x, y)
+
+    def bounds(self):
+        """Return the (minimum, maximum) of the X and Y values seen so far, if the intervals
+of the histogram were not specified."""
+        if self.counts is not None:
+            return ((None, None), (None, None))
+        (x, y) = self.data()
+        if not len(x):
+            return ((None, None), (None, None))
+        return ((self.xrng or (x.min(), x.max())), (self.yrng or (y.min(), y.max())))
+
+    def finish(self, xrng=None, yrng=None):
+        if self.counts is None:
+            (x, y) = self.data()
+            xrng = self.xrng or xrng or ((x.min(), x.max()) if len(x) else (0, 1))
+            yrng = self.yrng or yrng or ((y.min(), y.max()) if len(y) else (0, 1))
+            (self.counts, self.xedges, self.yedges) = self.histogram(x, y, [xrng, yrng])
+            self._chunks = []
+
+    def report(self, out, order, prefix=""):
+        self.finish()
+        (xe, ye) = (self.xedges, self.yedges)
+        if self.matrix:
+            out.write(prefix + "".join([ "\t{:f}:{:f}".format(ye[j], ye[j+1]) for j in range(len(ye) - 1) ]) + "\n")
+            for i in range(len(xe) - 1):
+                out.write("{}{:f}:{:f}\t{}\n".format(prefix, xe[i], xe[i+1], "\t".join([ str(n) for n in self.counts[i] ])))
+        else:
+            for i in range(len(xe) - 1):
+                for j in range(len(ye) - 1):
+                    out.write("{}{:f}\t{:f}\t{:f}\t{:f}\t{}\n".format(prefix, xe[i], xe[i+1], ye[j], ye[j+1], self.counts[i][j]))
+
+class Grouped(object):
+    """A separate histogram for each distinct value of a key column. Values are added as
+(key, value) pairs; `factory' is called to create the histogram for each new key. The
+numerical histograms of all groups share the same bin edges."""
+    factory = None
+    groups = {}                 # key => histogram object
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.groups = {}
+
+    def add(self, pairs):
+        byKey = {}
+        for (k, v) in pairs:
+            if k in byKey:
+                byKey[k].append(v)
+            else:
+                byKey[k] = [v]
+        for (k, values) in byKey.items():
+            if k not in self.groups:
+                self.groups[k] = self.factory()
+            self.groups[k].add(values)
+
+    def merge(self, other):
+        for (k, h) in other.groups.items():
+            if k in self.groups:
+                self.groups[k].merge(h)
+            else:
+                self.groups[k] = h
+        other.groups = {}
+
+    def report(self, out, order, prefix=""):
+        histos = [ self.groups[k] for k in sorted(self.groups) ]
+        if histos and isinstance(histos[0], Numerical):
+            rng = (None, None)
+            for h in histos:
+                rng = mergeRange(rng, h.bounds())
+            for h in histos:
+                h.finish(rng if rng[0] is not None else None)
+        elif histos and isinstance(histos[0], Joint):
+            xrng = yrng = (None, None)
+            for h in histos:
+                (hx, hy) = h.bounds()
+                (xrng, yrng) = (mergeRange(xrng, hx), mergeRange(yrng, hy))
+            for h in histos:
+                h.finish(xrng if xrng[0] is not None else None, yrng if yrng[0] is not None else None)
+        for k in sorted(self.groups):
+            self.groups[k].report(out, order, "{}{}\t".format(prefix, k))
+
+    def cleanup(self):
+        for h in self.groups.values():
+            if hasattr(h, "cleanup"):
+                h.cleanup()
 
 class Histo(object):
     filename = "/dev/stdin"
     outfile = "/dev/stdout"
-    column = 0
+    columns = [(0, None)]       # List of (column, kind); kind is "cat", "quant", or None for the default mode
     mode = "cat"                # or "quant" for quantitative
     order = "alpha"             # or "asc" or "desc" for numerical
     nbins = 0                   # for quant mode
-    _values = None
+    range = None                # (min, max) of histogram, for quant mode
+    percentiles = [1, 5, 25, 50, 75, 95, 99]   # for pct mode
+    sketch = False              # If True, estimate numerical histograms without --range from a sketch
+    top = 0                     # If set, only report the `top' most frequent categorical values
+    exact = False               # If True, --top is computed exactly, spilling counts to disk
+    spill = 0                   # Maximum number of distinct categorical values kept in memory
+    jobs = 1                    # Number of worker processes
+    groupby = None              # If set, compute a separate histogram for each value in this column
+    matrix = False              # If True, write 2D histograms in matrix format
+    blocksize = 4194304         # Number of bytes of input parsed at a time
+    encoding = locale.getpreferredencoding(False)  # Encoding of the input, in all workers
+    histos = []                 # List of (column, histogram object)
 
     def __init__(self):
-        self._values = defaultdict(int)
+        self.columns = [(0, None)]
+        self.histos = []
 
     def parseArgs(self, args):
         if "-h" in args or "--help" in args:
             self.usage()
             return False
         prev = ""
+        pairs = []
         for a in args:
             if prev == "-o":
                 self.outfile = a
                 prev = ""
             elif prev == "-c":
-                self.column = int(a) - 1
+                self.columns = parseColumns(a)
                 prev = ""
             elif prev == "-b":
                 self.nbins = int(a)
                 self.mode = "quant"
                 prev = ""
-            elif a in ["-o", "-c", "-b"]:
+            elif prev == "--range":
+                self.range = parseRange(a)
+                prev = ""
+            elif prev == "--quantiles":
+                if a != "-":
+                    self.percentiles = parseFloats(a)
+                self.mode = "pct"
+                prev = ""
+            elif prev == "--top":
+                self.top = int(a)
+                prev = ""
+            elif prev == "--spill":
+                self.spill = int(a)
+                prev = ""
+            elif prev == "-j":
+                self.jobs = int(a)
+                prev = ""
+            elif prev == "--group-by":
+                self.groupby = int(a) - 1
+                prev = ""
+            elif prev == "-2":
+                pairs.append(parsePair(a))
+                prev = ""
+            elif a in ["-o", "-c", "-b", "--range", "--quantiles", "--top", "--spill", "-j", "--group-by", "-2"]:
                 prev = a
+            elif a == "--matrix":
+                self.matrix = True
+            elif a == "--sketch":
+                self.sketch = True
+            elif a == "--exact":
+                self.exact = True
             elif a == "-n":
                 self.order = "desc"
             elif a == "-N":
                 self.order = "asc"
             else:
                 self.filename = a
+        self.columns = [ (c, kind or self.mode) for (c, kind) in self.columns ]
+        if pairs:
+            if "-c" not in args:
+                self.columns = []
+            self.columns += [ (p, "2d") for p in pairs ]
+        if not self.nbins:
+            self.nbins = 10
+        if self.exact and not self.spill:
+            self.spill = 1000000
         return True
 
     def usage(self):
@@ -50,9 +714,38 @@ Usage: histogram.py [options] [filename]
 
 Where options are:
 
-  -o O | Write output to file O.
-  -c C | Read values from column C of input (default: {}).
-  -b B | Use B bins (enables numerical mode).
+  -o O | Write output to file O. If O contains {{}}, each column is written to a
+         separate file, with {{}} replaced by the column number.
+  -c C | Read values from column C of input (default: {}). C can be a comma-separated
+         list of columns, whose histograms are all computed in a single pass over the
+         input. Add `n' or `c' to a column number to make its histogram numerical or
+         categorical regardless of -b, or `q' to report its quantiles (eg: -c 2,3n,5c).
+  -b B | Use B bins (enables numerical mode). Numerical histograms of columns
+         specified with `n' use 10 bins unless -b is specified.
+  --range MIN,MAX | In numerical mode, compute the histogram over the interval from
+         MIN to MAX (values outside it are ignored). Default: from the minimum
+         to the maximum value in the input.
+  --quantiles P | Quantile mode: report the specified percentiles (a comma-separated
+         list of numbers between 0 and 100, or - for the default:
+         {}) of the
+         values, as well as their number, minimum, maximum and interquartile range.
+  --sketch | In numerical mode without --range, estimate the histogram from a quantile
+         sketch in a single pass, instead of finding the minimum and maximum first.
+         Counts are approximate (see below).
+  --top K | In categorical mode, only report the K most frequent values, using a
+         fixed amount of memory (see below).
+  --exact | Compute --top exactly, keeping at most 1,000,000 distinct values in memory
+         unless --spill is specified.
+  --spill N | In categorical mode, keep at most N distinct values in memory; when
+         there are more, their counts are written to temporary files (in $TMPDIR),
+         which are merged at the end. Output is exact.
+  -j N | Use N worker processes, each one reading a separate portion of the input
+         (only if the input is a regular, uncompressed file).
+  -2 X,Y | Compute the two-dimensional histogram of the values in columns X and Y,
+         with B bins on each axis (default: 10). May be specified more than once,
+         and combined with -c.
+  --matrix | Write two-dimensional histograms as a matrix (see below).
+  --group-by G | Compute a separate histogram for each distinct value in column G.
   -n   | Sort categorical histogram by number of occurrences (descending).
   -N   | Sort categorical histogram by number of occurrences (ascending).
 
@@ -67,53 +760,208 @@ In numerical mode (enabled with -b) output consists of three columns:
   min max occurrences
 
 where min and max are the edges of each bin (see numpy.histogram() for details).
+Values are parsed and counted in large chunks, so memory use does not depend on the
+size of the input. If --range is not specified and the input is a regular file, a
+first pass over the file finds the minimum and maximum values; otherwise (eg, when
+reading from standard input) the values are kept in memory as a NumPy array.
+
+With -2, output consists of five columns:
+
+  xmin xmax ymin ymax occurrences
+
+one line for each bin; rows in which either value is not a number are ignored. Pairs
+are counted in chunks into a matrix of fixed size, so, as in numerical mode, memory
+use does not depend on the size of the input if --range is specified (the same
+interval is used for X and Y) or the input is a regular file. With --matrix, output
+is instead a table with one row for each bin of X and one column for each bin of Y,
+whose headers have the form min:max.
+
+With -j, the input file is split into N byte ranges aligned to line boundaries, and
+each worker computes partial histograms (and, if needed, minimum and maximum values)
+for its range; the partial results are then merged.
+
+In quantile mode, output consists of two columns (statistic and value). Percentiles are
+estimated in a single pass using a KLL sketch, which uses a fixed amount of memory; the
+estimates are typically within 0.2% of the exact rank. With --sketch, numerical histograms
+are estimated from the same kind of sketch, using its (exact) minimum and maximum as the
+histogram range, so a single pass over the input is needed even when reading from
+standard input. Bin counts are then approximate, and each histogram is preceded by the
+header line:
+
+  #min max ~occurrences
+
+
+With --top, output consists of three columns (value, occurrences, and maximum error),
+sorted by decreasing number of occurrences. Values are counted with the Space-Saving
+algorithm using 10*K counters: the reported number of occurrences of each value is an
+upper bound, exceeding the true one by at most the reported error, and any value that
+makes up more than 1/(10*K) of the input is guaranteed to be found. With --exact, the
+error is always 0.
+
+When more than one column is specified and the output is not split into separate
+files, output is a single table in long format, whose first column is the number
+of the input column each line refers to.
+
+With --group-by, each line is preceded by the value of column G it refers to, and groups
+are written in alphabetical order. All numerical histograms of the same column have the
+same bin edges, so they can be compared directly. Rows that do not have column G are
+ignored.
+
+""".format(self.columns[0][0] + 1, ",".join([ "{:g}".format(p) for p in self.percentiles ])))
+
+    def readBlocks(self, span=None):
+        """Iterate over the input in blocks of about `blocksize' bytes, yielding for each
+block the list of its parsed rows. If `span' is a (start, end) pair of byte offsets,
+only read the lines starting at or after `start' and before `end'."""
+        if span:
+            for rows in self.readSpan(span):
+                yield rows
+            return
+        with open(self.filename, "r", encoding=self.encoding) as f:
+            while True:
+                lines = f.readlines(self.blocksize)
+                if not lines:
+                    return
+                yield list(csv.reader(lines, delimiter='\t'))
 
-""".format(self.column + 1))
+    def readSpan(self, span):
+        (start, end) = span
+        with open(self.filename, "rb") as f:
+            if start > 0:
+                f.seek(start - 1)
+                f.readline()        # skip the line that started in the previous span
+            pos = f.tell()
+            while pos < end:
+                data = f.read(min(self.blocksize, end - pos))
+                if not data:
+                    return
+                if not data.endswith(b"\n"):
+                    data += f.readline()
+                pos += len(data)
+                yield list(csv.reader(io.StringIO(data.decode(self.encoding), newline=None), delimiter='\t'))
+
+    def isSeekable(self):
+        return os.path.isfile(self.filename)
+
+    def findRanges(self, columns, span=None):
+        """Return a dictionary mapping each of `columns' to the (minimum, maximum) of its values,
+reading the input (or the byte range `span' of it) once."""
+        ranges = dict([ (c, (None, None)) for c in columns ])
+        for rows in self.readBlocks(span):
+            for c in columns:
+                chunk = toFloatArray([ r[c] for r in rows if len(r) > c ])
+                if len(chunk):
+                    ranges[c] = mergeRange(ranges[c], (chunk.min(), chunk.max()))
+        return ranges
+
+    def makeHistos(self, pool=None, spans=None):
+        """Create the histogram objects for all columns. If `pool' is specified, the
+minimum and maximum values are found in parallel over the byte ranges `spans'."""
+        numcols = [ c for (c, kind) in self.columns if kind == "quant" ]
+        for (c, kind) in self.columns:
+            if kind == "2d":
+                numcols += [ x for x in c if x not in numcols ]
+        ranges = {}
+        if numcols:
+            if self.range:
+                ranges = dict([ (c, self.range) for c in numcols ])
+            elif self.isSeekable() and not self.sketch:
+                if pool:
+                    partial = pool.map(findRangesWorker, [ (self, numcols, span) for span in spans ])
+                    ranges = dict([ (c, (None, None)) for c in numcols ])
+                    for p in partial:
+                        for c in numcols:
+                            ranges[c] = mergeRange(ranges[c], p[c])
+                else:
+                    ranges = self.findRanges(numcols)
+        self.histos = []
+        for (c, kind) in self.columns:
+            if kind == "cat":
+                if self.top and not self.exact:
+                    factory = functools.partial(TopK, self.top)
+                elif self.spill:
+                    factory = functools.partial(SpillingCategorical, self.spill, self.top)
+                else:
+                    factory = Categorical
+            elif kind == "pct":
+                factory = functools.partial(Percentiles, self.percentiles)
+            elif kind == "2d":
+                (xrng, yrng) = [ ranges.get(x) for x in c ]
+                if xrng and xrng[0] is None:
+                    xrng = (0, 1)
+                if yrng and yrng[0] is None:
+                    yrng = (0, 1)
+                factory = functools.partial(Joint, self.nbins, xrng, yrng, self.matrix)
+            else:
+                rng = ranges.get(c)
+                if rng and rng[0] is None:
+                    rng = (0, 1)    # no values at all: same edges as histogram([])
+                factory = functools.partial(Numerical, self.nbins, rng, self.sketch)
+            if self.groupby is None:
+                self.histos.append((c, factory()))
+            else:
+                self.histos.append((c, Grouped(factory)))
+
+    def addRows(self, rows):
+        """Add the values from the parsed `rows' to all histograms."""
+        g = self.groupby
+        for (c, h) in self.histos:
+            if isinstance(c, tuple):
+                (x, y) = c
+                n = max(x, y)
+                if g is None:
+                    h.add([ (r[x], r[y]) for r in rows if len(r) > n ])
+                else:
+                    h.add([ (r[g], (r[x], r[y])) for r in rows if len(r) > n and len(r) > g ])
+            elif g is None:
+                h.add([ r[c] for r in rows if len(r) > c ])
+            else:
+                h.add([ (r[g], r[c]) for r in rows if len(r) > c and len(r) > g ])
 
     def run(self):
-        if self.mode == "cat":
-            self.runCategorical()
-            self.reportCategorical()
+        if self.jobs > 1 and self.isSeekable():
+            self.runParallel()
         else:
-            self.runNumerical()
-
-    def runCategorical(self):
-        with open(self.filename, "r") as f:
-            c = csv.reader(f, delimiter='\t')
-            for line in c:
-                w = line[self.column]
-                self._values[w] += 1
-
-    def reportCategorical(self):
-        counts = []
-        for k in self._values.keys():
-            counts.append( [ k, self._values[k] ])
-        if self.order == "alpha":
-            counts.sort(key=lambda r: r[0])
-        elif self.order == "asc":
-            counts.sort(key=lambda r: r[1])
-        elif self.order == "desc":
-            counts.sort(key=lambda r: r[1], reverse=True)
-        with open(self.outfile, "w") as out:
-            for cnt in counts:
-                out.write("{}\t{}\n".format(cnt[0], cnt[1]))
-
-    def runNumerical(self):
-        data = []
-        with open(self.filename, "r") as f:
-            c = csv.reader(f, delimiter='\t')
-            for line in c:
-                try:
-                    data.append(float(line[self.column]))
-                except ValueError:
-                    pass
-        hist, edges = histogram(data, bins=self.nbins)
-        with open(self.outfile, "w") as out:
-            for i in range(len(hist)):
-                out.write("{:f}\t{:f}\t{}\n".format(edges[i], edges[i+1], hist[i]))
+            self.makeHistos()
+            for rows in self.readBlocks():
+                self.addRows(rows)
+        self.report()
+
+    def runParallel(self):
+        spans = splitFile(self.filename, self.jobs)
+        pool = multiprocessing.Pool(self.jobs)
+        try:
+            self.makeHistos(pool, spans)
+            partial = pool.map(countWorker, [ (self, span) for span in spans ])
+        finally:
+            pool.close()
+            pool.join()
+        self.histos = partial[0]
+        for histos in partial[1:]:
+            for ((c, h), (c2, h2)) in zip(self.histos, histos):
+                h.merge(h2)
+
+    def report(self):
+        if "{}" in self.outfile:
+            for (c, h) in self.histos:
+                with open(self.outfile.format(columnLabel(c)), "w") as out:
+                    h.report(out, self.order)
+        else:
+            with open(self.outfile, "w") as out:
+                for (c, h) in self.histos:
+                    prefix = "{}\t".format(columnLabel(c)) if len(self.histos) > 1 else ""
+                    h.report(out, self.order, prefix)
+
+    def cleanup(self):
+        for (c, h) in self.histos:
+            if hasattr(h, "cleanup"):
+                h.cleanup()
 
 if __name__ == "__main__":
     args = sys.argv[1:]
     H = Histo()
     if H.parseArgs(args):
-        H.run()
+        try:
+            H.run()
+        finally:
+            H.cleanup()
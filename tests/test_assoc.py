@@ -0,0 +1,59 @@
+import os
+import sys
+import subprocess
+
+ASSOC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "assoc.py")
+
+def run(args, stdin="", cwd=None):
+    p = subprocess.run([sys.executable, ASSOC] + args, input=stdin, capture_output=True,
+                       text=True, cwd=cwd)
+    return p.stdout
+
+def writeTable(path, rows):
+    with open(path, "w") as out:
+        for r in rows:
+            out.write("\t".join(r) + "\n")
+    return str(path)
+
+def test_duplicate_key_same_in_all_modes(tmp_path):
+    table = writeTable(tmp_path / "T.tsv", [("a", "1"), ("b", "2"), ("a", "3")])
+    words = run([table, "a"])
+    stream = run([table], stdin="a\n")
+    indexed = run(["--index", table], stdin="a\n")
+    indexedWords = run(["--index", table, "a"])
+    assert words == stream == indexed == indexedWords == "3\n"
+
+def test_first_uses_first_row(tmp_path):
+    table = writeTable(tmp_path / "T.tsv", [("a", "1"), ("b", "2"), ("a", "3")])
+    assert run(["--first", table, "a"]) == "1\n"
+
+def test_join_whole_line_uses_stream_delimiter(tmp_path):
+    table = writeTable(tmp_path / "T.tsv", [("a", "1", "X"), ("b", "2", "Y")])
+    out = run(["-c", "1", "-D", ",", "-a", "-w", table], stdin="a,q\nc,s\n")
+    assert out == "a,q,a,1,X\nc,s,???\n"
+
+def test_join_whole_line_with_table_delimiter(tmp_path):
+    table = tmp_path / "T.csv"
+    table.write_text('a,"2,5",X\nb,3,Y\n')
+    out = run(["-d", ",", "-c", "1", "-D", ";", "-a", "-w", str(table)], stdin="a;q\n")
+    assert out == "a;q;a;2,5;X\n"
+    out = run(["-d", ",", "-c", "1", "-a", "-w", str(table)], stdin="a\tq\n")
+    assert out == "a\tq\ta\t2,5\tX\n"
+
+def test_keep_first_only_for_keys_missing_from_first_table(tmp_path):
+    first = writeTable(tmp_path / "A.tsv", [("t1", "g1"), ("t2", "g9")])
+    second = writeTable(tmp_path / "B.tsv", [("g1", "S1"), ("t2", "WRONG"), ("t3", "S3")])
+    out = run(["-K", "-H", second, first], stdin="t1\nt2\nt3\n")
+    assert out == "S1\n???\nS3\n"
+
+def test_prefix_empty_query_is_missing(tmp_path):
+    table = writeTable(tmp_path / "T.tsv", [("ENSG1.1", "A"), ("ENSG1.2", "B"), ("ENSG2.1", "C")])
+    assert run(["--prefix", table], stdin="ENSG1\n\nENSG2\n") == "A\nB\n???\nC\n"
+    assert run(["--prefix", "-x", table], stdin="ENSG1\n\nENSG2\n") == "A\nB\nC\n"
+
+def test_range_rejects_empty_and_odd_bounds(tmp_path):
+    table = writeTable(tmp_path / "T.tsv", [("a", "1"), ("b", "2"), ("c", "3")])
+    assert run(["--range", table], stdin="a b\n\nc\n") == "1\n2\n???\n???\n"
+    p = subprocess.run([sys.executable, ASSOC, "--range", table, "a", "b", "c"],
+                       capture_output=True, text=True)
+    assert p.returncode == 1 and p.stdout == ""
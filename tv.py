@@ -11,22 +11,211 @@ __email__ = "ariva@ufl.edu"
 __license__ = "GPL v3.0"
 __copyright__ = "Copyright 2018, University of Florida Research Foundation"
 
+import re
 import sys
 import csv
 import time
 import curses
-
-PY3 = (sys.version_info.major == 3)
-
-if PY3:
-    from curses import wrapper
-else:
-    from curses.wrapper import wrapper
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from collections import OrderedDict
+from curses import wrapper
 
 def writeDelimiter(d):
     x = "t" if ord(d) == 9 else d
     return x
 
+def nthLine(data, start, n):
+    """Return the offset of the line following the `n'th newline in `data' after `start'
+(which must exist). Uses count() to narrow down its position, instead of looking for
+each newline in turn."""
+    lo = start
+    seen = 0                    # newlines between start and lo
+    step = 4096
+    while True:                 # find an interval containing it, doubling its size
+        hi = min(lo + step, len(data))
+        m = data.count(b"\n", lo, hi)
+        if seen + m >= n:
+            break
+        seen += m
+        lo = hi
+        step *= 2
+    while hi - lo > 256:
+        mid = (lo + hi) // 2
+        m = data.count(b"\n", lo, mid)
+        if seen + m >= n:
+            hi = mid
+        else:
+            seen += m
+            lo = mid
+    for k in range(n - seen):
+        lo = data.find(b"\n", lo) + 1
+    return lo
+
+class LineIndex(object):
+    """Index of the lines in a file, built by a background thread. Only the offset of the first
+line of each block of `blocksize' lines is recorded, so any block can be read directly
+while using little memory. `nlines' grows while the index is being built, and `done'
+becomes True when the whole file has been indexed."""
+    filename = None
+    blocksize = 256
+    offsets = None              # array of offsets of the first line of each block
+    nlines = 0
+    done = False
+    thread = None
+
+    def __init__(self, filename, blocksize=256):
+        self.filename = filename
+        self.blocksize = blocksize
+        self.offsets = array('Q', [0])
+        self.nlines = 0
+        self.done = False
+        self.thread = threading.Thread(target=self.build)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def build(self):
+        bs = self.blocksize
+        pos = 0
+        last = b"\n"
+        with open(self.filename, "rb") as f:
+            while True:
+                chunk = f.read(1048576)
+                if not chunk:
+                    break
+                i = 0
+                left = chunk.count(b"\n")
+                while True:
+                    tonext = bs - self.nlines % bs
+                    if left < tonext:
+                        self.nlines += left
+                        break
+                    i = nthLine(chunk, i, tonext)
+                    self.offsets.append(pos + i)
+                    self.nlines += tonext
+                    left -= tonext
+                last = chunk[-1:]
+                pos += len(chunk)
+        if last != b"\n":
+            self.nlines += 1    # last line has no newline
+        self.done = True
+
+class Row(object):
+    """A row of a delimited file, stored as the raw line. The offsets at which fields start
+are computed the first time a field is accessed, and fields are then sliced out of the
+line only when needed, so that wide rows take little more memory than their text. Lines
+containing quotes are split into a list of fields with the csv module instead."""
+    __slots__ = ("line", "delim", "starts", "fields")
+
+    def __init__(self, line, delim):
+        self.line = line.rstrip("\r\n")
+        self.delim = delim
+        self.starts = None
+        self.fields = None
+
+    def split(self):
+        if not self.line:
+            self.fields = []
+        elif '"' in self.line:
+            self.fields = next(csv.reader([self.line], delimiter=self.delim))
+        else:
+            lengths = map(len, self.line.split(self.delim))
+            self.starts = array('L', [0])
+            self.starts.extend(accumulate(map((1).__add__, lengths)))
+
+    def __len__(self):
+        if self.starts is None and self.fields is None:
+            self.split()
+        if self.fields is not None:
+            return len(self.fields)
+        return len(self.starts) - 1
+
+    def __getitem__(self, i):
+        if self.starts is None and self.fields is None:
+            self.split()
+        if self.fields is not None:
+            return self.fields[i]
+        return self.line[self.starts[i]:self.starts[i+1] - 1]
+
+class Search(object):
+    """Search for the rows of a file that match a regular expression, run by a background
+thread that reads the file in large blocks. The numbers of the matching rows are appended
+to `matches' as they are found, and `done' becomes True when the whole file has been
+scanned. If `column' is not None, only the values in that column are matched."""
+    filename = None
+    pattern = ""
+    regex = None
+    delim = None
+    column = None
+    blocksize = 4194304
+    matches = None
+    done = False
+    stopped = False
+    thread = None
+
+    def __init__(self, filename, pattern, delim, column=None):
+        self.filename = filename
+        self.pattern = pattern
+        self.regex = re.compile(pattern, re.MULTILINE)
+        self.delim = delim
+        self.column = column
+        self.matches = array('L')
+        self.done = False
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        base = 0
+        with open(self.filename, "r", newline="\n") as f:   # split lines like LineIndex
+            while not self.stopped:
+                lines = f.readlines(self.blocksize)
+                if not lines:
+                    break
+                if self.column is None:
+                    self.searchLines(lines, base)
+                else:
+                    self.searchColumn(lines, base)
+                base += len(lines)
+        self.done = True
+
+    def searchLines(self, lines, base):
+        """Find the matching lines in a block, by searching all of them at once."""
+        text = "".join(lines)
+        search = self.regex.search
+        pos = 0
+        lineno = base
+        linestart = 0
+        while True:
+            m = search(text, pos)
+            if not m or m.start() == len(text):
+                return
+            start = text.rfind("\n", 0, m.start()) + 1
+            lineno += text.count("\n", linestart, start)
+            linestart = start
+            self.matches.append(lineno)
+            pos = text.find("\n", m.start()) + 1
+            if pos == 0:
+                return
+
+    def searchColumn(self, lines, base):
+        search = self.regex.search
+        c = self.column
+        delim = self.delim
+        for (i, line) in enumerate(lines):
+            if '"' in line:
+                fields = Row(line, delim)
+            else:
+                fields = line.rstrip("\r\n").split(delim, c + 1)
+            if len(fields) > c and search(fields[c]):
+                self.matches.append(base + i)
+
+    def stop(self):
+        self.stopped = True
+
 class TDFile():
     filename = None
     label = ""
@@ -34,16 +223,27 @@ class TDFile():
     delimname = ""
     quotechar = None
     rmode = False
-    data = []
-    nrows = 0
+    index = None                # LineIndex for this file
+    blocks = None               # LRU cache of blocks of rows
+    cached = 0                  # Total size of the rows in cache
+    maxcached = 67108864        # Maximum size of the rows in cache
+    sample = None               # First rows of the file, used to find column widths
+    maxsample = 4194304         # Maximum size of the sample
     ncols = 0
-    colsizes = None
+    colsizes = None             # Width of each column, or None if not computed yet
     row = 0
     col = 0
     gap = 1
     maxrows = 1000
     header = False
-    
+    _f = None
+    _layout = None              # Parameters the formatted rows depend on
+    _formatted = None           # Cache of formatted rows, by row number
+    _screen = None              # (text, attribute) of each line currently on screen
+    _first = 0                  # Row displayed at the top of the screen (below the header)
+    search = None               # Current Search, if any
+    message = None              # If set, displayed in the status line instead of the usual information
+
     def __init__(self, filename):
         self.filename = filename
         if self.delim is None:
@@ -51,45 +251,153 @@ class TDFile():
             self.delimname = writeDelimiter(self.delim)
             # sys.stderr.write("Delimiter: {} {}\n".format(self.delim, self.delimname))
             # raw_input()
-        rows_read = 0
-        self.data = []
-        first = True
-        with open(self.filename, "r") as f:
-            c = self.openReader(f)
-            for parsed in c:
-                if first and self.rmode:
-                    parsed = ['\t'] + parsed
-                    first = False
-                ll = len(parsed)
-                self.nrows += 1
-                if self.colsizes:
-                    for i in range(self.ncols):
-                        if i < ll:
-                            self.colsizes[i] = max(self.colsizes[i], len(parsed[i]))
-                else:
-                    self.ncols = len(parsed)
-                    self.colsizes = [len(w) for w in parsed]
-                self.data.append(parsed)
-                rows_read += 1
-                if rows_read >= self.maxrows:
+        self.index = LineIndex(filename)
+        self.blocks = OrderedDict()
+        self.cached = 0
+        self._f = open(self.filename, "r", newline="\n")   # split lines like the index does
+        self.sample = []
+        size = 0
+        with open(self.filename, "r", newline="\n") as f:
+            for line in f:
+                self.sample.append(Row(line, self.delim))
+                size += len(line)
+                if len(self.sample) >= self.maxrows or size >= self.maxsample:
                     break
+        if self.sample:
+            if self.rmode:
+                self.sample[0].fields = ['\t'] + list(self.sample[0])
+            self.ncols = len(self.sample[0])
+        self.colsizes = [None] * self.ncols
         self.row = 0
         self.col = 0
 
-    def openReader(self, f):
-        if self.delim == ',':
-            return csv.reader(f, delimiter=self.delim, quotechar='"')
+    @property
+    def nrows(self):
+        return self.index.nlines
+
+    def getBlock(self, b):
+        """Return the parsed rows in block `b', reading them from the file if they are not
+in the cache."""
+        if b in self.blocks:
+            (rows, size) = self.blocks.pop(b)
+            self.blocks[b] = (rows, size)       # now the most recently used
+            return rows
+        bs = self.index.blocksize
+        self._f.seek(self.index.offsets[b])
+        rows = []
+        size = 0
+        for i in range(bs):
+            line = self._f.readline()
+            if not line:
+                break
+            rows.append(Row(line, self.delim))
+            size += len(line)
+        if b == 0 and self.rmode and rows:
+            rows[0].fields = ['\t'] + list(rows[0])
+        if len(rows) == bs or self.index.done:  # don't cache blocks that may still grow
+            while self.blocks and self.cached + size > self.maxcached:
+                self.cached -= self.blocks.popitem(last=False)[1][1]
+            self.blocks[b] = (rows, size)
+            self.cached += size
+        return rows
+
+    def colsize(self, c):
+        """Return the width of column `c', computing it from the sample rows if necessary."""
+        if self.colsizes[c] is None:
+            self.colsizes[c] = max([0] + [ len(row[c]) for row in self.sample if len(row) > c ])
+        return self.colsizes[c]
+
+    def fitColumns(self, rows, w):
+        """Widen the columns visible in a window of width `w' if necessary, to fit the values
+in `rows'. Returns the number of the first column that is not visible."""
+        xpos = 0
+        c = self.col
+        while c < self.ncols and xpos < w:
+            size = self.colsize(c)
+            for rdata in rows:
+                if len(rdata) > c and len(rdata[c]) > size:
+                    size = len(rdata[c])
+            self.colsizes[c] = size
+            xpos += size + self.gap
+            c += 1
+        return c
+
+    def getRow(self, r):
+        """Return the fields of row `r'."""
+        rows = self.getBlock(r // self.index.blocksize)
+        i = r % self.index.blocksize
+        return rows[i] if i < len(rows) else []
+
+    def waitIndex(self, win, nrows=None):
+        """Wait until at least `nrows' rows (or the whole file, if None) have been indexed,
+showing progress in the status line. Any key interrupts the wait. Returns True if the
+requested rows are available."""
+        if nrows is None:
+            ready = lambda: self.index.done
+        else:
+            ready = lambda: self.nrows >= nrows
+        self.waitFor(win, ready, lambda: not self.index.done,
+                     lambda: "Indexing... {} rows (press any key to stop)".format(self.nrows))
+        return ready()
+
+    def waitFor(self, win, ready, running, message):
+        """Wait until ready() is true or running() is false, showing the result of message()
+in the status line. Any key interrupts the wait."""
+        (h, w) = win.getmaxyx()
+        win.nodelay(True)
+        try:
+            while running() and not ready():
+                win.move(h-1, 0)
+                win.clrtoeol()
+                win.addstr(message(), curses.A_BOLD)
+                win.refresh()
+                if win.getch() != -1:
+                    break
+                time.sleep(0.1)
+        finally:
+            win.nodelay(False)
+
+    def busy(self):
+        """Return True if indexing or searching are in progress."""
+        return not self.index.done or (self.search is not None and not self.search.done)
+
+    def startSearch(self, pattern, column=None):
+        if self.search:
+            self.search.stop()
+        self.search = None
+        if pattern:
+            self.search = Search(self.filename, pattern, self.delim, column)
+
+    def gotoMatch(self, win, forward):
+        """Move to the next (or previous, if `forward' is False) row matching the current
+search, waiting for it to be found if necessary."""
+        sr = self.search
+        if forward:
+            found = lambda: bisect_right(sr.matches, self.row) < len(sr.matches)
+            self.waitFor(win, found, lambda: not sr.done,
+                         lambda: "Searching... {} matches so far (press any key to stop)".format(len(sr.matches)))
+            if found():
+                r = sr.matches[bisect_right(sr.matches, self.row)]
+            else:
+                self.message = "Pattern not found" if sr.done else None
+                return
         else:
-            return csv.reader(f, delimiter=self.delim)
-        
+            i = bisect_left(sr.matches, self.row)
+            if i == 0:
+                self.message = "Pattern not found"
+                return
+            r = sr.matches[i - 1]
+        if self.waitIndex(win, r + 1):
+            self.row = r
+
+
     def detectDelimiter(self):
         hits = {'\t': 0, ',': 0, ';': 0, ':': 0}
         with open(self.filename, "r") as f:
             for i in range(5):
                 line = f.readline()
-                for ch in line:
-                    if ch in hits:
-                        hits[ch] += 1
+                for ch in hits:
+                    hits[ch] += line.count(ch)
         best = ''
         bestc = 0
 
@@ -102,55 +410,101 @@ class TDFile():
         #time.sleep(1)
         return best
 
-    def writeLine(self, win, ypos, w, rdata, attr):
+    def formatRow(self, rdata, w):
+        """Return the text of row `rdata' as displayed in a window of width `w'."""
+        line = ""
         xpos = 0
-        l = len(rdata)
         c = self.col
-        while True:
-            if c >= l:
-                break
+        l = min(len(rdata), self.ncols)
+        while c < l:
             toDisplay = rdata[c]
-            if xpos + self.colsizes[c] >= w:
-                av = w - xpos - 2
+            if xpos + self.colsize(c) >= w:
+                av = max(0, w - xpos - 2)
                 if len(toDisplay) > av:
                     toDisplay = toDisplay[:av] + " >"
-            win.addstr(toDisplay, attr)
-            xpos += self.colsizes[c] + self.gap
+            line = line[:xpos].ljust(xpos) + toDisplay
+            xpos += self.colsize(c) + self.gap
             if xpos >= w:
                 break
-            win.move(ypos, xpos)
             c += 1
-            if c >= self.ncols:
-                break
+        return line[:w]
+
+    def getFormatted(self, r, w):
+        if r not in self._formatted:
+            if len(self._formatted) > 4096:
+                self._formatted = {}
+            self._formatted[r] = self.formatRow(self.getRow(r), w)
+        return self._formatted[r]
+
+    def invalidate(self):
+        """Force the next call to display() to redraw the whole window."""
+        self._screen = None
 
     def display(self, win):
-        """Display the current view of the file in window `win'."""
+        """Display the current view of the file in window `win'. Only the lines that changed
+since the previous call are redrawn, and when the view moves by less than a page,
+the lines still visible are scrolled instead of being redrawn. Formatted rows are
+cached until the column offset, the gap, or the column widths change."""
         (h, w) = win.getmaxyx()
-        ypos = 0
-        r = self.row
-        win.move(0, 0)
-        win.erase()
-        if self.header:
-            self.writeLine(win, 0, w, self.data[0], curses.A_BOLD)
-            ypos = 1
-            win.move(1, 0)
-            if r == 0:
-                r = 1
         maxrow = h - 1
-        while True:
-            rdata = self.data[r]
-            self.writeLine(win, ypos, w, rdata, curses.A_NORMAL)
-            r += 1
-            ypos += 1
-            xpos = 0
-            if ypos == maxrow or r == self.nrows:
-                break
-            win.move(ypos, xpos)
+        top = 1 if self.header else 0
+        r = self.row
+        if self.header and r == 0:
+            r = 1
+        nums = list(range(r, min(r + maxrow - top, self.nrows)))
+        if self.header and self.nrows:
+            nums.insert(0, 0)
+        lastcol = self.fitColumns([ self.getRow(i) for i in nums ], w)
+        layout = (h, w, self.col, self.gap, self.header, tuple(self.colsizes[self.col:lastcol]))
+        if layout != self._layout:
+            self._layout = layout
+            self._formatted = {}
+            self._screen = None
+        lines = [ (self.getFormatted(i, w), curses.A_NORMAL) for i in nums ]
+        if self.header and lines:
+            lines[0] = (lines[0][0], curses.A_BOLD)
+        lines += [ ("", curses.A_NORMAL) ] * (maxrow - len(lines))
+
+        if self._screen is None:
+            win.erase()
+            self._screen = [ None ] * maxrow
+        else:
+            shift = r - self._first
+            if 0 < abs(shift) < maxrow - top - 1:
+                win.setscrreg(top, maxrow - 1)
+                win.scrollok(True)
+                win.scroll(shift)
+                win.scrollok(False)
+                win.setscrreg(0, h - 1)
+                body = self._screen[top:]
+                if shift > 0:
+                    body = body[shift:] + [ ("", curses.A_NORMAL) ] * shift
+                else:
+                    body = [ ("", curses.A_NORMAL) ] * -shift + body[:shift]
+                self._screen[top:] = body
+        self._first = r
+        for ypos in range(maxrow):
+            if lines[ypos] != self._screen[ypos]:
+                win.move(ypos, 0)
+                win.clrtoeol()
+                (text, attr) = lines[ypos]
+                if text:
+                    win.addnstr(text, w, attr)
+                self._screen[ypos] = lines[ypos]
         win.move(maxrow, 0)
-        win.addstr("[{}] Row: {}/{} Col: {}/{}".format(self.delimname, self.row + 1, self.nrows, self.col + 1, self.ncols), curses.A_BOLD)
+        win.clrtoeol()
+        if self.message:
+            win.addstr(self.message, curses.A_BOLD)
+        else:
+            win.addstr("[{}] Row: {}/{}{} Col: {}/{}".format(self.delimname, self.row + 1, self.nrows, "" if self.index.done else "+", self.col + 1, self.ncols), curses.A_BOLD)
+            sr = self.search
+            if sr:
+                win.addstr(" {}{}{} {} matches{}".format("" if sr.column is None else "[{}] ".format(sr.column + 1),
+                                                     "/", sr.pattern, len(sr.matches), "" if sr.done else "+"), curses.A_BOLD)
         win.move(maxrow, w - len(self.label) - 1)
         win.addstr(self.label, curses.A_BOLD)
-        win.refresh()
+        win.noutrefresh()
+        curses.doupdate()
 
     def left(self):
         if self.col > 0:
@@ -167,14 +521,15 @@ class TDFile():
 
     def down(self):
         self.row += 1
-        if self.row == self.nrows:
+        if self.row >= self.nrows:
             self.row += -1
 
     def top(self):
         self.row = 0
 
-    def bottom(self):
-        self.row = self.nrows - 1
+    def bottom(self, win):
+        self.waitIndex(win)
+        self.row = max(0, self.nrows - 1)
 
     def pageup(self, win):
         (h, w) = win.getmaxyx()
@@ -198,12 +553,34 @@ class TDFile():
             curses.noecho()
         try:
             r = int(r)
-            if r <= 0 or r > self.nrows:
+            if r <= 0 or not self.waitIndex(win, r):
                 return
             self.row = r - 1
         except ValueError:
             pass
 
+    def askSearch(self, win, column=False):
+        """Prompt for a regular expression, search for it in the whole file (or in the
+current column only, if `column' is True), and jump to the first matching row after
+the current one. An empty pattern clears the current search."""
+        (h, w) = win.getmaxyx()
+        win.move(h-1, 0)
+        win.clrtoeol()
+        win.addstr("Search{}: ".format(" column {}".format(self.col + 1) if column else ""), curses.A_BOLD)
+        try:
+            curses.echo()
+            pattern = win.getstr()
+        finally:
+            curses.noecho()
+        pattern = pattern.decode("utf-8", "replace")
+        try:
+            self.startSearch(pattern, self.col if column else None)
+        except re.error:
+            self.message = "Invalid regular expression: {}".format(pattern)
+            return
+        if self.search:
+            self.gotoMatch(win, True)
+
     def askColumn(self, win):
         (h, w) = win.getmaxyx()
         win.move(h-1, 0)
@@ -235,7 +612,9 @@ Usage: tv.py [options] filenames...
 
 Options:
   -d D | Use character D as delimiter (use 'tab' for tab). Default: autodetect.
-  -m M | Read the first M lines from each input file (default: {}).
+  -m M | Use the first M lines of each input file to determine initial column
+         widths (default: {}). Columns are widened as needed when displaying
+         later rows.
   -b   | Enable header mode (first line bold and always visible).
 
 While displaying a file, the following keys can be used:
@@ -249,11 +628,28 @@ While displaying a file, the following keys can be used:
   r           | prompt for row number, jump to it
   c           | prompt for column number, jump to it
   h           | toggle header mode
-  n           | jump to next file
+  /           | prompt for a regular expression, search for it in the whole file
+  \\           | prompt for a regular expression, search for it in the current column
+  n, N        | jump to next, previous row matching the search
+  Esc         | clear the search
+  n           | jump to next file (if no search is active)
   p           | jump to previous file
   +/-         | increase, decrease gap between columns
   q, Q        | quit
 
+Files are opened immediately, and indexed in the background: while indexing is in
+progress, the number of rows in the status line is followed by `+'. End, and jumping
+to a row that has not been indexed yet, wait for indexing to reach it (press any key
+to stop waiting). Rows are read from the file as needed, and the most recently viewed
+ones are kept in memory. Each line of the file is one row; rows are only split into
+fields when displayed, and only the visible fields are extracted, so even very wide
+files can be scrolled quickly.
+
+Searches run in the background over the whole file, and the status line shows the
+number of matches found so far; the column is the first visible one when the search
+is started. While a search is active, `n' jumps to the next match instead of the next
+file; an empty pattern or Esc clears it.
+
 (c) 2018, A. Riva, ICBR Bioinformatics Core, University of Florida
 
 """.format(TDFile.maxrows))
@@ -306,10 +702,27 @@ class Driver():
 
     def run(self, win, tdf):
         curses.curs_set(0)
+        win.idlok(True)
+        tdf.invalidate()
         while True:
             tdf.display(win)
+            win.timeout(500 if tdf.busy() else -1)    # Update counts while indexing or searching
             a = win.getch()
-            if a in [113, 81]:      # Quit (q, Q)
+            win.timeout(-1)
+            if a == -1:
+                continue
+            tdf.message = None
+            if a == ord('/'):
+                tdf.askSearch(win)
+            elif a == ord('\\'):
+                tdf.askSearch(win, True)
+            elif a == ord('n') and tdf.search:
+                tdf.gotoMatch(win, True)
+            elif a == ord('N') and tdf.search:
+                tdf.gotoMatch(win, False)
+            elif a == 27:       # Esc
+                tdf.startSearch(None)
+            elif a in [113, 81]:      # Quit (q, Q)
                 self.quitting = True
                 break
             elif a == ord('n'):
@@ -333,7 +746,7 @@ class Driver():
             elif a == curses.KEY_HOME:
                 tdf.top()
             elif a == curses.KEY_END:
-                tdf.bottom()
+                tdf.bottom(win)
             elif a == curses.KEY_PPAGE:
                 tdf.pageup(win)
             elif a in [curses.KEY_NPAGE, 32]: